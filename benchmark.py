@@ -0,0 +1,793 @@
+"""Benchmarks offline do bot (nada vai para a rede: Telegram, Notion e Gemini são simulados).
+
+Uso:
+    python benchmark.py resumo [--linhas 200 1000 4000] [--rodadas 3]
+    python benchmark.py ids [--chamados 2000] [--lotes 3]
+    python benchmark.py webhook [--updates 5000] [--chats 200] [--clientes 50] [--latencia 0.02]
+    python benchmark.py replay [--fluxo botoes rajada voz lock] [--chats 100] [--arquivo updates.jsonl]
+    python benchmark.py shards [--workers 1 2 4] [--updates 4000] [--cpu 2]
+    python benchmark.py busca [--chamados 5000] [--comentarios 20] [--consultas 500]
+    python benchmark.py analitico [--eventos 2000000] [--chats 500] [--dias 90]
+    python benchmark.py boot [--clientes 2000] [--latencia 0.3]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+# Estado, logs e caches do bot vão para um diretório temporário
+BENCH_DIR = tempfile.mkdtemp(prefix='bot_bench_')
+os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+os.environ.setdefault('STATE_FILE', os.path.join(BENCH_DIR, 'bot_state.pkl'))
+os.environ.setdefault('STATE_DB', os.path.join(BENCH_DIR, 'bot_state.db'))
+os.environ.setdefault('LOG_DIR', os.path.join(BENCH_DIR, 'logs_sessao'))
+os.environ.setdefault('AUDIO_CACHE_DIR', os.path.join(BENCH_DIR, 'cache_transcricoes'))
+os.environ.setdefault('ESPELHO_DB', os.path.join(BENCH_DIR, 'chamados.db'))
+os.environ.setdefault('ANALITICO_DIR', os.path.join(BENCH_DIR, 'analitico'))
+os.environ.setdefault('NOTION_TICKETS_DB_ID', 'bench-tickets')
+os.environ.setdefault('NOTION_CLIENTS_DB_ID', 'bench-clients')
+import bot
+
+# --- GEMINI FALSO ---
+# Latência = fixa + proporcional ao tamanho do prompt (prefill) + proporcional à resposta (geração)
+FAKE_LATENCIA_BASE = 0.4
+FAKE_SEG_POR_MIL_CHARS_ENTRADA = 0.02
+FAKE_SEG_POR_MIL_CHARS_SAIDA = 1.0
+FAKE_UPLOAD_LATENCIA = 0.2 # upload do áudio (síncrono no SDK, roda em thread)
+
+class FakeModel:
+    calls = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    async def generate_content_async(self, prompt):
+        FakeModel.calls += 1
+        text = prompt if isinstance(prompt, str) else " ".join(str(p) for p in prompt)
+        if "Transcreva" in text:
+            reply = "Bom dia, a internet da filial caiu de novo desde cedo, já reiniciei o roteador."
+        elif "ESTRUTURA:" in text:
+            reply = "🚩 OCORRÊNCIA\nCliente sem sinal na OLT.\n\n🛠️ AÇÕES REALIZADAS\n• Reset da porta PON\n\n🏁 SITUAÇÃO ATUAL\nNormalizado.\n[NOVO_TITULO: Sem sinal OLT]\n[FECHAR_CHAMADO]"
+        else:
+            reply = "• Problema: sem sinal\n• Ação: reset da PON\n• Cliente: 'funcionou, pode fechar'"
+        await asyncio.sleep(FAKE_LATENCIA_BASE + len(text) / 1000 * FAKE_SEG_POR_MIL_CHARS_ENTRADA + len(reply) / 1000 * FAKE_SEG_POR_MIL_CHARS_SAIDA)
+        return SimpleNamespace(text=reply)
+
+def fake_upload_file(data, mime_type=None):
+    time.sleep(FAKE_UPLOAD_LATENCIA)
+    return SimpleNamespace(name=f"files/{uuid.uuid4().hex[:8]}", state=SimpleNamespace(name="ACTIVE"))
+
+def install_fake_gemini():
+    bot.genai.GenerativeModel = FakeModel
+    bot.genai.upload_file = fake_upload_file
+    bot.genai.get_file = lambda name: SimpleNamespace(name=name, state=SimpleNamespace(name="ACTIVE"))
+    bot.model_handles.clear()
+
+def fake_session_log(n_lines, seed=0):
+    rnd = random.Random(seed)
+    users = ["Ana", "Carlos", "Suporte"]
+    words = "olt pon sinal onu reset porta cliente caiu voltou teste ping perda latência rota bgp vlan".split()
+    lines = [f"{rnd.choice(users)}: " + " ".join(rnd.choice(words) for _ in range(rnd.randint(5, 30))) for _ in range(n_lines)]
+    lines.append("Ana: funcionou, pode fechar")
+    return lines
+
+# --- NOTION FALSO ---
+# Mesma interface assíncrona do notion_client.AsyncClient para o que o bot usa, com latência fixa.
+FAKE_NOTION_LATENCIA = 0.05
+
+def title_of(page):
+    try: return page['properties']['Name']['title'][0]['text']['content']
+    except (KeyError, IndexError): return None
+
+class FakeNotion:
+    def __init__(self, latency=FAKE_NOTION_LATENCIA):
+        self.latency = latency
+        self.pages = {}
+        self.children = {}
+        self.calls = {}
+        self.databases = SimpleNamespace(query=self.query)
+        self.pages_api = SimpleNamespace(create=self.create, retrieve=self.retrieve, update=self.update)
+        self.blocks = SimpleNamespace(children=SimpleNamespace(append=self.append, list=self.list))
+
+    def add_page(self, database_id, properties):
+        # Semeia uma página sem contar chamada nem latência
+        page = {'id': str(uuid.uuid4()), 'object': 'page', 'parent': {'database_id': database_id}, 'properties': properties, 'archived': False,
+                'last_edited_time': bot.datetime.now(bot.pytz.utc).isoformat()}
+        self.pages[page['id']] = page
+        return page
+
+    async def _io(self, endpoint):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    def _touch(self, page_id):
+        if page_id in self.pages: self.pages[page_id]['last_edited_time'] = bot.datetime.now(bot.pytz.utc).isoformat()
+
+    async def query(self, database_id, filter=None, page_size=100, start_cursor=None, sorts=None, **kwargs):
+        await self._io('databases.query')
+        found = [p for p in self.pages.values() if p['parent']['database_id'] == database_id and self._match(p, filter)]
+        if sorts: found.sort(key=lambda p: p['last_edited_time'], reverse=sorts[0].get('direction') == 'descending')
+        start = int(start_cursor or 0)
+        more = start + page_size < len(found)
+        return {'results': found[start:start + page_size], 'has_more': more, 'next_cursor': str(start + page_size) if more else None}
+
+    def _match(self, page, f):
+        if not f: return True
+        if 'and' in f: return all(self._match(page, sub) for sub in f['and'])
+        if 'timestamp' in f: return page['last_edited_time'] >= f['last_edited_time']['on_or_after']
+        prop = page['properties'].get(f['property'], {})
+        if 'title' in f: return title_of(page) == f['title']['equals']
+        if 'status' in f: return prop.get('status', {}).get('name') == f['status']['equals']
+        if 'checkbox' in f: return prop.get('checkbox') == f['checkbox']['equals']
+        if 'rich_text' in f: return bool(prop.get('rich_text')) and prop['rich_text'][0]['text']['content'] == f['rich_text']['equals']
+        return True
+
+    async def create(self, parent, properties):
+        await self._io('pages.create')
+        page = {'id': str(uuid.uuid4()), 'object': 'page', 'parent': parent, 'properties': properties, 'archived': False,
+                'last_edited_time': bot.datetime.now(bot.pytz.utc).isoformat()}
+        self.pages[page['id']] = page
+        return page
+
+    async def retrieve(self, page_id):
+        await self._io('pages.retrieve')
+        return self.pages[page_id]
+
+    async def update(self, page_id, properties):
+        await self._io('pages.update')
+        self.pages[page_id]['properties'].update(properties)
+        self._touch(page_id)
+        return self.pages[page_id]
+
+    async def append(self, block_id, children):
+        await self._io('blocks.children.append')
+        self.children.setdefault(block_id, []).extend(children)
+        self._touch(block_id)
+        return {'results': children}
+
+    async def list(self, block_id, page_size=100, start_cursor=None):
+        await self._io('blocks.children.list')
+        blocks = self.children.get(block_id, [])
+        start = int(start_cursor or 0)
+        more = start + page_size < len(blocks)
+        return {'results': blocks[start:start + page_size], 'has_more': more, 'next_cursor': str(start + page_size) if more else None}
+
+def install_fake_notion(latency=FAKE_NOTION_LATENCIA):
+    fake = FakeNotion(latency)
+    bot.notion = SimpleNamespace(databases=fake.databases, pages=fake.pages_api, blocks=fake.blocks)
+    return fake
+
+def seed_clients(fake, n):
+    chats = [-1000000 - i for i in range(n)]
+    for i, cid in enumerate(chats):
+        fake.add_page(bot.NOTION_CLIENTS_DB_ID, {'Name': {'title': [{'text': {'content': f"Cliente {i:04d}"}}]},
+                                                 'ChatID': {'rich_text': [{'text': {'content': str(cid)}}]}, 'Ativo': {'checkbox': True}})
+    return chats
+
+# --- TELEGRAM FALSO ---
+# Responde às chamadas da Bot API sem rede, com latência fixa; getFile/download devolvem um áudio falso.
+from telegram.request import BaseRequest
+
+FAKE_TELEGRAM_LATENCIA = 0.03
+FAKE_AUDIO = b"OggS" + bytes(4096)
+BOT_USER = {'id': 123, 'is_bot': True, 'first_name': "Bench", 'username': "bench_bot"}
+
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = {}
+        self.events = [] # (perf_counter, método, chat_id)
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self): return None
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if '/file/bot' in url: return 200, FAKE_AUDIO
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint != 'getMe' and self.latency: await asyncio.sleep(self.latency)
+        self.events.append((time.perf_counter(), endpoint, params.get('chat_id')))
+        if endpoint == 'getMe': result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {'message_id': params.get('message_id') or next(self.message_ids), 'date': int(time.time()), 'from': BOT_USER,
+                      'chat': {'id': int(params.get('chat_id') or 0), 'type': 'supergroup'}, 'text': params.get('text', "")}
+        elif endpoint == 'getFile':
+            fid = params.get('file_id')
+            result = {'file_id': fid, 'file_unique_id': f"u{fid}", 'file_size': len(FAKE_AUDIO), 'file_path': f"voice/{fid}.oga"}
+        else: result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+def fake_application(handlers=(), latency=0):
+    from telegram.ext import ApplicationBuilder
+    app = (ApplicationBuilder().token("123:BENCH").updater(None).request(FakeTelegramRequest(latency))
+           .concurrent_updates(bot.ChatUpdateProcessor(bot.MAX_UPDATES_ADMITIDOS, bot.MAX_UPDATES_SIMULTANEOS)).build())
+    for h in handlers: app.add_handler(h)
+    return app
+
+# --- CENÁRIOS ---
+async def bench_resumo(args):
+    install_fake_gemini()
+    print(f"{'linhas':>7} {'chars':>8} {'modo':>10} {'p50 (s)':>8} {'min (s)':>8}  tags")
+    for n in args.linhas:
+        lines = fake_session_log(n)
+        for mode in ('single', 'mapreduce'):
+            times, tags = [], True
+            for _ in range(args.rodadas):
+                t0 = time.perf_counter()
+                out = await bot.generate_ai_analysis(lines, "sem sinal", True, "manual", mode=mode)
+                times.append(time.perf_counter() - t0)
+                tags = tags and "[FECHAR_CHAMADO]" in out and "[NOVO_TITULO:" in out
+            print(f"{n:>7} {len(chr(10).join(lines)):>8} {mode:>10} {statistics.median(times):>8.2f} {min(times):>8.2f}  {'ok' if tags else 'FALTANDO'}")
+
+async def bench_ids(args):
+    # Teste de estresse: muitos create_ticket ao mesmo tempo, com "restart" (recarga do estado) entre lotes
+    fake = install_fake_notion(latency=0.001)
+    issued = []
+    for lote in range(args.lotes):
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(bot.create_ticket("Bench", f"chamado {i}", -i) for i in range(args.chamados)))
+        elapsed = time.perf_counter() - t0
+        errors = [e for _, e in results if e]
+        ids = [tid for tid, _ in results if tid]
+        issued.extend(ids)
+        await bot.flush_state()
+        dict.clear(bot.bot_meta)
+        bot.load_state()
+        print(f"lote {lote + 1}: {len(ids)} chamados em {elapsed:.2f}s ({len(ids) / elapsed:.0f}/s), erros: {len(errors)}")
+    unique = len(set(issued)) == len(issued)
+    ordered = issued == sorted(issued)
+    titles = [title_of(p) for p in fake.pages.values()]
+    print(f"total: {len(issued)} | únicos: {'ok' if unique else 'DUPLICADOS'} | ordenados: {'ok' if ordered else 'FORA DE ORDEM'} | títulos únicos no Notion: {'ok' if len(set(titles)) == len(titles) else 'DUPLICADOS'}")
+    print(f"exemplos: {issued[0]} ... {issued[-1]}")
+    return 0 if unique and ordered else 1
+
+# --- UPDATES SINTÉTICOS ---
+def fake_user(chat_id):
+    return {'id': 100000 + abs(chat_id) % 100000, 'is_bot': False, 'first_name': "Bench", 'username': f"user{abs(chat_id)}"}
+
+def fake_message(update_id, chat_id, **fields):
+    return {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Grupo {chat_id}"},
+            'from': fake_user(chat_id), **fields}
+
+def fake_text_update(update_id, chat_id, text):
+    return {'update_id': update_id, 'message': fake_message(update_id, chat_id, text=text)}
+
+def fake_command_update(update_id, chat_id, command):
+    return {'update_id': update_id, 'message': fake_message(update_id, chat_id, text=f"/{command}", entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}])}
+
+def fake_voice_update(update_id, chat_id):
+    return {'update_id': update_id, 'message': fake_message(update_id, chat_id, voice={'file_id': f"voz{update_id}", 'file_unique_id': f"uvoz{update_id}", 'duration': 5, 'mime_type': "audio/ogg"})}
+
+def fake_callback_update(update_id, chat_id, data):
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'supergroup'}, 'from': BOT_USER, 'text': "menu"}
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': fake_user(chat_id), 'chat_instance': str(chat_id), 'data': data, 'message': message}}
+
+def update_kind(data):
+    if 'callback_query' in data: return "btn:" + data['callback_query']['data'].split('_')[0]
+    msg = data.get('message', {})
+    if msg.get('voice'): return "msg:voice"
+    if msg.get('text', "").startswith('/'): return "cmd:" + msg['text'].split()[0][1:]
+    return "msg:text"
+
+# Fluxos: para cada chat, uma lista de passos; passos rodam em sequência, os updates de um passo chegam juntos
+def flow_open_ticket(ids, cid):
+    return [[fake_command_update(next(ids), cid, 'start')], [fake_callback_update(next(ids), cid, 'check')],
+            [fake_callback_update(next(ids), cid, 'wait_yes')], [fake_text_update(next(ids), cid, "Sem internet na filial desde cedo")]]
+
+def flow_buttons(ids, cid, args):
+    return flow_open_ticket(ids, cid) + [[fake_callback_update(next(ids), cid, data)] for data in ('list_view', 'list_update', 'back', 'cancel')]
+
+def flow_burst(ids, cid, args):
+    return flow_open_ticket(ids, cid) + [[fake_text_update(next(ids), cid, f"mensagem {i} " + "detalhe " * (i % 10)) for i in range(args.mensagens)]]
+
+def flow_voice(ids, cid, args):
+    return flow_open_ticket(ids, cid) + [[fake_voice_update(next(ids), cid)] for _ in range(args.audios)]
+
+def flow_lock_setup(ids, cid, args):
+    return flow_open_ticket(ids, cid) + [[fake_text_update(next(ids), cid, f"mensagem {i}")] for i in range(5)]
+
+FLOWS = {'botoes': flow_buttons, 'rajada': flow_burst, 'voz': flow_voice, 'lock': flow_lock_setup}
+
+def load_recorded_flow(path):
+    # JSON lines com updates reais da Bot API; cada chat é reproduzido em ordem, um update por passo
+    steps = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip(): continue
+            data = json.loads(line)
+            msg = data.get('message') or data.get('callback_query', {}).get('message') or {}
+            steps.setdefault(msg.get('chat', {}).get('id'), []).append([data])
+    return steps
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def bench_webhook(args):
+    # Carga HTTP de ponta a ponta: POST -> servidor aiohttp -> fila -> ChatUpdateProcessor -> handler.
+    # O handler só simula trabalho (sleep); o objetivo é medir o caminho de entrada, não os handlers reais.
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    bot.WEBHOOK_HOST, bot.WEBHOOK_PORT, bot.WEBHOOK_SECRET = '127.0.0.1', args.porta, 'bench'
+    seen = {}
+    async def handler(update, context):
+        await asyncio.sleep(args.latencia)
+        seen.setdefault(update.effective_chat.id, []).append(update.update_id)
+    app = fake_application([TypeHandler(Update, handler)])
+    await app.initialize()
+    runner = await bot.start_webhook_server(app)
+    url = f"http://127.0.0.1:{args.porta}{bot.WEBHOOK_PATH}"
+    statuses = {}
+    sem = asyncio.Semaphore(args.clientes)
+    # Gerador de carga também em aiohttp (o pool do httpx vira o gargalo com muitas conexões)
+    import aiohttp
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.clientes)) as http:
+        async def post_chat(chat):
+            # Como o Telegram, os updates de um mesmo chat vão em sequência
+            for i in range(chat, args.updates + 1, args.chats):
+                async with sem, http.post(url, json=fake_text_update(i, -chat, f"msg {i}"), headers={'X-Telegram-Bot-Api-Secret-Token': 'bench'}) as r:
+                    statuses[r.status] = statuses.get(r.status, 0) + 1
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post_chat(c) for c in range(1, args.chats + 1)))
+        t_http = time.perf_counter() - t0
+        await bot.webhook_queue.join()
+        t_all = time.perf_counter() - t0
+        async with http.post(url, json=fake_text_update(0, -1, "x")) as r: denied = r.status
+    await bot.stop_webhook_server(runner)
+    await app.shutdown()
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    print(f"updates: {args.updates} | chats: {args.chats} | clientes HTTP: {args.clientes} | handler: {args.latencia * 1000:.0f}ms")
+    print(f"HTTP: {t_http:.2f}s ({args.updates / t_http:.0f} req/s) | respostas: {statuses}")
+    print(f"ponta a ponta: {t_all:.2f}s ({statuses.get(200, 0) / t_all:.0f} updates/s) | ordem por chat: {'ok' if ordered else 'FORA DE ORDEM'}")
+    print(f"sem secret: {denied} | {bot.webhook_stats_text()}")
+    return 0 if ordered and denied == 403 else 1
+
+async def replay(app, steps_by_chat):
+    # Passa cada update pelo mesmo caminho do polling: ChatUpdateProcessor -> Application.process_update -> handlers
+    from telegram import Update
+    latencies = []
+    async def one(data):
+        update = Update.de_json(data, app.bot)
+        t0 = time.perf_counter()
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies.append((update_kind(data), time.perf_counter() - t0))
+    async def run_chat(steps):
+        for step in steps: await asyncio.gather(*(one(d) for d in step))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(run_chat(steps) for steps in steps_by_chat.values()))
+    return latencies, time.perf_counter() - t0
+
+async def drain_background():
+    # Transcrições, resumos IA e buffer do Notion que os handlers deixaram para depois
+    t0 = time.perf_counter()
+    await bot.audio_queue.join()
+    await bot.summary_queue.join()
+    for tid in list(bot.notion_outbox): await bot.flush_ticket_outbox(tid)
+    await bot.flush_state()
+    return time.perf_counter() - t0
+
+def print_latencies(title, latencies, elapsed, drained):
+    times = [t for _, t in latencies]
+    print(f"{title}: {len(times)} updates em {elapsed:.2f}s ({len(times) / elapsed:.0f} updates/s) | p50 {percentile(times, 0.5) * 1000:.0f}ms"
+          f" | p99 {percentile(times, 0.99) * 1000:.0f}ms | máx {max(times, default=0) * 1000:.0f}ms | fundo: {drained:.2f}s")
+    kinds = {}
+    for kind, t in latencies: kinds.setdefault(kind, []).append(t)
+    for kind, ts in sorted(kinds.items()):
+        print(f"    {kind:<14} {len(ts):>6}x  p50 {percentile(ts, 0.5) * 1000:>6.0f}ms  p99 {percentile(ts, 0.99) * 1000:>6.0f}ms")
+
+async def bench_lock(app, request):
+    # Fechamento das 18h: todos os grupos abertos de uma vez; mede o tempo até cada grupo ser travado
+    open_chats = [c for c in bot.CLIENT_GROUPS if bot.group_status.get(c) == 'OPEN']
+    t0 = time.perf_counter()
+    mark = len(request.events)
+    await bot.scheduled_lock(app)
+    elapsed = time.perf_counter() - t0
+    locked = {}
+    for t, endpoint, cid in request.events[mark:]:
+        if endpoint == 'setChatPermissions': locked.setdefault(cid, t - t0)
+    times = list(locked.values())
+    print(f"lock 18h: {len(locked)}/{len(open_chats)} grupos em {elapsed:.2f}s ({len(locked) / elapsed:.0f} grupos/s)"
+          f" | até travar p50 {percentile(times, 0.5) * 1000:.0f}ms | p99 {percentile(times, 0.99) * 1000:.0f}ms")
+
+async def bench_replay(args):
+    fake_notion = install_fake_notion(args.latencia_notion)
+    install_fake_gemini()
+    chats = seed_clients(fake_notion, args.chats)
+    app = fake_application(latency=args.latencia_telegram)
+    bot.register_handlers(app)
+    await app.initialize()
+    await bot.job_init(app)
+    request = app.bot.request
+    ids = itertools.count(1)
+    runs = [(f"arquivo {args.arquivo}", load_recorded_flow(args.arquivo))] if args.arquivo else [(f"fluxo {name}", {cid: FLOWS[name](ids, cid, args) for cid in chats}) for name in args.fluxo]
+    for title, steps in runs:
+        latencies, elapsed = await replay(app, steps)
+        print_latencies(title, latencies, elapsed, await drain_background())
+        if title == "fluxo lock": await bench_lock(app, request)
+    errors = sum(n for (name, _), n in bot.metric_counters.items() if name == 'bot_handler_erros_total')
+    print(f"Telegram: {dict(sorted(request.calls.items()))}")
+    print(f"Notion: {dict(sorted(fake_notion.calls.items()))}")
+    print(f"Gemini: {FakeModel.calls} chamadas | erros em handlers: {errors}")
+    await bot.job_stop(app)
+    await app.shutdown()
+    return 1 if errors else 0
+
+# --- SHARDS ---
+# Workers em processos separados (spawn: cada um importa o bot com o próprio SHARD_ID pelo ambiente);
+# o router roda neste processo. O handler queima CPU, que é o que um processo único não consegue escalar.
+def shard_worker_main(cpu_ms, processed, disorder):
+    asyncio.run(shard_worker(cpu_ms, processed, disorder))
+
+async def shard_worker(cpu_ms, processed, disorder):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    last = {}
+    async def handler(update, context):
+        end = time.perf_counter() + cpu_ms / 1000
+        while time.perf_counter() < end: pass
+        cid = update.effective_chat.id
+        if update.update_id < last.get(cid, 0):
+            with disorder.get_lock(): disorder.value += 1
+        last[cid] = update.update_id
+        with processed.get_lock(): processed.value += 1
+    app = fake_application([TypeHandler(Update, handler)])
+    await app.initialize()
+    bot.load_state()
+    await bot.start_webhook_server(app)
+    await asyncio.Event().wait()
+
+def start_shard_workers(urls, args, processed, disorder, only=None):
+    ctx = multiprocessing.get_context('spawn')
+    procs, saved = [], dict(os.environ)
+    try:
+        for url in only or urls:
+            os.environ.update({'SHARD_MODO': 'worker', 'SHARD_ID': url, 'SHARD_WORKERS': ",".join(urls), 'STATE_BACKEND': 'sqlite',
+                               'WEBHOOK_HOST': '127.0.0.1', 'WEBHOOK_PORT': url.rsplit(':', 1)[1], 'WEBHOOK_SECRET': 'bench'})
+            p = ctx.Process(target=shard_worker_main, args=(args.cpu, processed, disorder), daemon=True)
+            p.start()
+            procs.append(p)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return procs
+
+async def wait_router_live(n, timeout=60):
+    deadline = time.monotonic() + timeout
+    while len(bot.router_live) != n:
+        if time.monotonic() > deadline: raise TimeoutError(f"router viu {len(bot.router_live)}/{n} workers")
+        await asyncio.sleep(0.2)
+        await bot.router_health_check()
+
+async def wait_router_boot(url, old, timeout=60):
+    # Reinício entre dois health checks: o router só percebe pelo boot id novo no /shard/saude
+    deadline = time.monotonic() + timeout
+    while bot.router_live.get(url) in (None, old):
+        if time.monotonic() > deadline: raise TimeoutError(f"router não viu o reinício de {url}")
+        await asyncio.sleep(0.2)
+        await bot.router_health_check()
+
+async def shard_load(args, first_id, n_updates, processed):
+    import aiohttp
+    url = f"http://127.0.0.1:{args.porta}{bot.WEBHOOK_PATH}"
+    statuses, sem = {}, asyncio.Semaphore(args.clientes)
+    start_count = processed.value
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.clientes)) as http:
+        async def post_chat(chat):
+            for i in range(first_id + chat, first_id + n_updates + 1, args.chats):
+                async with sem, http.post(url, json=fake_text_update(i, -chat, f"msg {i}"), headers={'X-Telegram-Bot-Api-Secret-Token': 'bench'}) as r:
+                    statuses[r.status] = statuses.get(r.status, 0) + 1
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post_chat(c) for c in range(1, args.chats + 1)))
+        while processed.value - start_count < statuses.get(200, 0): await asyncio.sleep(0.01)
+    return statuses, time.perf_counter() - t0
+
+async def bench_shards(args):
+    bot.WEBHOOK_HOST, bot.WEBHOOK_PORT, bot.WEBHOOK_SECRET = '127.0.0.1', args.porta, 'bench'
+    ctx = multiprocessing.get_context('spawn')
+    base, ok = None, True
+    for k in args.workers:
+        urls = [f"http://127.0.0.1:{args.porta + 1 + i}" for i in range(k)]
+        processed, disorder = ctx.Value('i', 0), ctx.Value('i', 0)
+        procs = start_shard_workers(urls, args, processed, disorder)
+        bot.SHARD_WORKERS = urls
+        bot.router_live.clear()
+        runner = await bot.start_router_server()
+        try:
+            await wait_router_live(k)
+            share = {}
+            for c in range(1, args.chats + 1): share[bot.router_ring.owner(-c)] = share.get(bot.router_ring.owner(-c), 0) + 1
+            statuses, elapsed = await shard_load(args, 0, args.updates, processed)
+            rate = statuses.get(200, 0) / elapsed
+            base = base or rate / k
+            print(f"{k} workers: {rate:>6.0f} updates/s ({rate / base:.1f}x de 1 worker) | respostas: {statuses} | fora de ordem: {disorder.value}"
+                  f" | chats por worker: {sorted(share.values())}")
+            ok = ok and disorder.value == 0
+            if k > 1:
+                # Um worker reinicia entre dois health checks: mesmo conjunto de workers, boot id novo
+                procs[0].terminate()
+                procs[0].join()
+                t0 = time.perf_counter()
+                old = bot.router_live.get(urls[0])
+                procs[0:1] = start_shard_workers(urls, args, processed, disorder, only=urls[:1])
+                await wait_router_boot(urls[0], old)
+                statuses, _ = await shard_load(args, args.updates, args.updates // 4, processed)
+                print(f"    reinício de 1 worker: anel reenviado em {time.perf_counter() - t0:.2f}s | depois: {statuses}")
+                ok = ok and set(statuses) == {200}
+                # Um worker sai: o router percebe no health check, rebalanceia e os chats dele vão para os outros
+                procs[-1].terminate()
+                procs[-1].join()
+                t0 = time.perf_counter()
+                await wait_router_live(k - 1)
+                moved = share.get(urls[-1], 0)
+                statuses, _ = await shard_load(args, args.updates + args.updates // 4, args.updates // 4, processed)
+                print(f"    saída de 1 worker: rebalanceado em {time.perf_counter() - t0:.2f}s, {moved} chats mudaram de dono | depois: {statuses}")
+                ok = ok and set(statuses) == {200}
+        finally:
+            for p in procs: p.terminate()
+            await runner.cleanup()
+            await bot.router_session.close()
+    return 0 if ok else 1
+
+# --- BUSCA / ESPELHO ---
+def fake_vocabulary(rnd, n=3000):
+    # Palavras inventadas com frequência Zipf: poucas muito comuns, cauda longa de raras (como texto de chamado)
+    syllables = "ba be bi bo ca ce co da de di do fa fe fi ga go la le li lo ma me mi mo na ne no pa pe po ra re ri ro sa se si so ta te ti to va ve vi".split()
+    words = list(dict.fromkeys("".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))) for _ in range(n * 2)))[:n]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return words, weights
+
+def seed_tickets(fake, n, comments, clients, seed=0):
+    # Chamados "antigos" (editados até ontem), com observações em blocos de parágrafo
+    rnd = random.Random(seed)
+    words, weights = fake_vocabulary(rnd)
+    text = lambda k: " ".join(rnd.choices(words, weights, k=k))
+    base = bot.datetime.now(bot.pytz.utc) - bot.timedelta(days=2)
+    for i in range(n):
+        page = fake.add_page(bot.NOTION_TICKETS_DB_ID, {'Name': {'title': [{'text': {'content': f"B{i:06d}"}}]},
+                                                        'Descricao': {'rich_text': [{'text': {'content': text(4)}}]},
+                                                        'Solicitante': {'rich_text': [{'text': {'content': "Bench"}}]},
+                                                        'Status': {'status': {'name': "Em Andamento" if i % 10 == 0 else "Finalizado"}},
+                                                        'ChatID': {'rich_text': [{'text': {'content': f"Cliente {i % clients:04d}"}}]}})
+        page['last_edited_time'] = (base + bot.timedelta(seconds=i)).isoformat()
+        fake.children[page['id']] = [bot.comment_block("01/01 10:00", "Bench", text(rnd.randint(5, 40))) for _ in range(comments)]
+    return words, weights
+
+async def timed_calls(fake, coro):
+    before = sum(fake.calls.values())
+    t0 = time.perf_counter()
+    out = await coro
+    return out, time.perf_counter() - t0, sum(fake.calls.values()) - before
+
+async def bench_busca(args):
+    fake = install_fake_notion(latency=args.latencia)
+    words, weights = seed_tickets(fake, args.chamados, args.comentarios, args.clientes)
+    m = bot.ticket_mirror
+    out, secs, calls = await timed_calls(fake, bot.sync_ticket_mirror())
+    print(f"sync completa: {secs:.2f}s, {calls} chamadas ao Notion | {out} | espelho: {bot.mirror_stats_text()}")
+    out, secs, calls = await timed_calls(fake, bot.sync_ticket_mirror())
+    print(f"sync incremental sem mudanças: {secs * 1000:.0f}ms, {calls} chamadas")
+    edited = random.Random(1).sample(list(fake.pages), min(20, len(fake.pages)))
+    for pid in edited: await fake.append(pid, [bot.comment_block("02/01 09:00", "Técnico", "troca do conector fibra rompida")])
+    out, secs, calls = await timed_calls(fake, bot.sync_ticket_mirror())
+    print(f"sync incremental com {len(edited)} chamados editados: {secs * 1000:.0f}ms, {calls} chamadas | {out}")
+    rnd = random.Random(2)
+    queries = [" ".join(rnd.choices(words, weights, k=rnd.randint(1, 3))) for _ in range(args.consultas)]
+    for client in (None, "Cliente 0000"):
+        times, hits = [], 0
+        for q in queries:
+            t0 = time.perf_counter()
+            hits += len(m.search(q, client) or [])
+            times.append(time.perf_counter() - t0)
+        print(f"busca ({'todos' if client is None else client}): {len(queries)} consultas | p50 {percentile(times, 0.5) * 1000:.2f}ms"
+              f" | p99 {percentile(times, 0.99) * 1000:.2f}ms | {hits / len(queries):.1f} resultados/consulta")
+    # As observações acrescentadas "direto no Notion" precisam ter chegado ao índice
+    found = {r[0] for r in m.search("troca conector", limit=len(edited)) or []}
+    ok = found == {title_of(fake.pages[pid]) for pid in edited}
+    # Leituras: espelho fresco x Notion (zerar synced_at força o caminho antigo)
+    tid = "B000000"
+    for label in ('espelho', 'notion'):
+        if label == 'notion': m.synced_at = 0
+        bot.history_cache.clear()
+        bot.active_tickets_cache.clear()
+        (entries, _), secs_h, calls_h = await timed_calls(fake, bot.get_ticket_history(tid))
+        desc, secs_d, calls_d = await timed_calls(fake, bot.get_ticket_desc(tid))
+        print(f"leitura via {label}: histórico {secs_h * 1000:.1f}ms ({calls_h} chamadas, {len(entries)} entradas) | descrição {secs_d * 1000:.1f}ms ({calls_d} chamadas)")
+    print(f"chamados editados encontrados na busca: {'ok' if ok else f'FALTANDO ({len(found)}/{len(edited)})'}")
+    m.close()
+    return 0 if ok else 1
+
+# --- ANALÍTICO ---
+def write_events(rows):
+    # rows: (ts, chat, user, kind, code) em ordem de ts; grava direto nas colunas do event_log
+    for row in rows:
+        for (name, _), value in zip(bot.ANALITICO_COLUNAS, row): bot.event_log.cols[name].append(value)
+    bot.event_log.flush()
+
+def synthetic_sessions(n_events, chats, days, seed=0):
+    # Sessões por chat: abertura, mensagens do cliente, resposta do suporte depois de um atraso, fechamento
+    rnd = random.Random(seed)
+    now, rows = time.time(), []
+    per_chat = n_events // chats
+    for c in range(chats):
+        cid, t = -2000000 - c, now - days * 86400
+        while per_chat > 0 and t < now and len(rows) < (c + 1) * per_chat:
+            client, staff = 1000 + c, 1
+            rows.append((t, cid, client, bot.EV_ABERTURA, 0))
+            t += rnd.uniform(5, 60)
+            if rnd.random() < 0.5: rows.append((t, cid, client, bot.EV_CHAMADO, 0))
+            for i in range(rnd.randint(2, 30)):
+                t += rnd.expovariate(1 / 120)
+                rows.append((t, cid, staff if i and rnd.random() < 0.4 else client, bot.EV_MENSAGEM, rnd.randrange(3)))
+            t += rnd.uniform(60, 1800)
+            rows.append((t, cid, 0, bot.EV_FECHAMENTO, rnd.choice([0, 1, 1, 2])))
+            t += rnd.expovariate(1 / (days * 86400 / max(1, per_chat / 18.5))) # ~18.5 eventos por sessão
+    rows.sort()
+    return [r for r in rows if r[0] < now]
+
+async def bench_analitico(args):
+    try: import numpy # noqa: F401
+    except ImportError:
+        print("numpy não instalado: pip install numpy")
+        return 1
+    # Correção: um chat com respostas conhecidas (1ª resposta 90s, duração 600s, fechado por inatividade)
+    t0 = time.time() - 3600
+    bot.CLIENT_GROUPS[-1] = "Cliente Conferência"
+    write_events([(t0, -1, 10, bot.EV_ABERTURA, 0), (t0 + 30, -1, 10, bot.EV_MENSAGEM, 0), (t0 + 40, -1, 10, bot.EV_CHAMADO, 0),
+                  (t0 + 90, -1, 20, bot.EV_MENSAGEM, 0), (t0 + 600, -1, 0, bot.EV_FECHAMENTO, bot.CAUSAS_FECHAMENTO.index('inatividade'))])
+    check = bot.analytics_report(1, {-1})
+    ok = "1ª resposta: p50 1m30s" in check and "Duração: p50 10m00s" in check and "inatividade 1" in check
+    print(check)
+    print(f"conferência: {'ok' if ok else 'DIVERGENTE'}\n")
+    # Escala: eventos sintéticos espalhados por --dias
+    t = time.perf_counter()
+    rows = synthetic_sessions(args.eventos, args.chats, args.dias)
+    gen = time.perf_counter() - t
+    t = time.perf_counter()
+    write_events(rows)
+    size = sum(f.stat().st_size for f in bot.event_log.path.iterdir())
+    print(f"{len(rows)} eventos gerados em {gen:.1f}s, gravados em {time.perf_counter() - t:.2f}s ({size / len(rows):.0f} bytes/evento, {size / 1e6:.1f} MB)")
+    for days in sorted({1, 7, 30, args.dias}):
+        times = []
+        for _ in range(3):
+            t = time.perf_counter()
+            text = bot.analytics_report(days)
+            times.append(time.perf_counter() - t)
+        print(f"/relatorio {days:>3}: {min(times) * 1000:7.1f}ms | {text.splitlines()[1]}")
+    t = time.perf_counter()
+    bot.analytics_report(args.dias, {-2000000})
+    print(f"/relatorio {args.dias} (um cliente): {(time.perf_counter() - t) * 1000:.1f}ms")
+    return 0 if ok else 1
+
+# --- BOOT ---
+# Cada medição é um processo novo (spawn: interpretador + import do bot entram na conta). O relógio começa no pai,
+# logo antes de criar o processo, e para quando o /start do primeiro update foi respondido.
+def boot_child_main(t0, args, out):
+    asyncio.run(boot_child(t0, args, out))
+
+async def boot_child(t0, args, out):
+    from telegram import Update
+    imported = time.time()
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+    fake = install_fake_notion(args.latencia)
+    chats = seed_clients(fake, args.clientes)
+    yesterday = (bot.datetime.now(bot.pytz.utc) - bot.timedelta(days=1)).isoformat()
+    for page in fake.pages.values(): page['last_edited_time'] = yesterday # diretório sem mudanças desde o último boot
+    install_fake_gemini()
+    app = fake_application()
+    bot.register_handlers(app)
+    await app.initialize()
+    await bot.job_init(app)
+    ready = time.time()
+    await app.process_update(Update.de_json(fake_command_update(1, chats[0], 'start'), app.bot))
+    first = time.time()
+    genai_loaded = 'google.generativeai' in sys.modules
+    if bot.boot_task: await bot.boot_task
+    done = time.time()
+    replied = any(e == 'sendMessage' and cid == chats[0] for _, e, cid in app.bot.request.events)
+    await bot.job_stop(app)
+    await app.shutdown()
+    out.put({'import': imported - t0, 'pronto': ready - t0, 'primeiro': first - t0, 'completo': done - t0,
+             'genai_no_primeiro': genai_loaded, 'respondeu': replied, 'clientes': len(bot.CLIENT_GROUPS)})
+
+def run_boot(args, fast):
+    ctx = multiprocessing.get_context('spawn')
+    out = ctx.Queue()
+    saved = dict(os.environ)
+    os.environ['BOOT_RAPIDO'] = '1' if fast else '0'
+    try:
+        t0 = time.time()
+        p = ctx.Process(target=boot_child_main, args=(t0, args, out))
+        p.start()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    result = out.get(timeout=300)
+    p.join()
+    return result
+
+def reset_boot_state():
+    # Boot a frio: sem estado persistido (nem snapshot/journal, nem logs/espelho)
+    for path in (bot.STATE_FILE, bot.STATE_JOURNAL, bot.STATE_DB, bot.ESPELHO_DB):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix): os.remove(path + suffix)
+
+async def bench_boot(args):
+    print(f"{'modo':>10} {'estado':>7} {'import':>8} {'pronto':>8} {'1º update':>10} {'completo':>9}  clientes  genai no 1º")
+    ok = True
+    for fast in (False, True):
+        reset_boot_state()
+        for state in ('frio', 'quente'):
+            r = run_boot(args, fast)
+            ok = ok and r['respondeu']
+            print(f"{'rápido' if fast else 'bloqueante':>10} {state:>7} {r['import']:>7.2f}s {r['pronto']:>7.2f}s {r['primeiro']:>9.2f}s {r['completo']:>8.2f}s"
+                  f"  {r['clientes']:>8}  {'sim' if r['genai_no_primeiro'] else 'não'}{'' if r['respondeu'] else '  SEM RESPOSTA'}")
+    return 0 if ok else 1
+
+SCENARIOS = {'resumo': bench_resumo, 'ids': bench_ids, 'webhook': bench_webhook, 'replay': bench_replay, 'shards': bench_shards, 'busca': bench_busca,
+             'analitico': bench_analitico, 'boot': bench_boot}
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmarks offline do bot")
+    sub = p.add_subparsers(dest='cenario', required=True)
+    r = sub.add_parser('resumo', help="Latência do resumo: prompt único x map-reduce")
+    r.add_argument('--linhas', type=int, nargs='+', default=[200, 1000, 4000])
+    r.add_argument('--rodadas', type=int, default=3)
+    r = sub.add_parser('ids', help="Estresse do gerador de IDs de chamado")
+    r.add_argument('--chamados', type=int, default=2000)
+    r.add_argument('--lotes', type=int, default=3)
+    r = sub.add_parser('webhook', help="Vazão do modo webhook com updates sintéticos")
+    r.add_argument('--updates', type=int, default=5000)
+    r.add_argument('--chats', type=int, default=200)
+    r.add_argument('--clientes', type=int, default=50, help="conexões HTTP simultâneas (o Telegram usa até 40)")
+    r.add_argument('--latencia', type=float, default=0.02, help="segundos de trabalho simulado por update")
+    r.add_argument('--porta', type=int, default=18443)
+    r = sub.add_parser('replay', help="Reproduz fluxos de updates pelos handlers reais, com Telegram/Notion/Gemini falsos")
+    r.add_argument('--fluxo', nargs='+', choices=list(FLOWS), default=list(FLOWS))
+    r.add_argument('--arquivo', help="JSON lines com updates gravados (substitui --fluxo)")
+    r.add_argument('--chats', type=int, default=100)
+    r.add_argument('--mensagens', type=int, default=20, help="mensagens por chat no fluxo rajada")
+    r.add_argument('--audios', type=int, default=3, help="áudios por chat no fluxo voz")
+    r.add_argument('--latencia-telegram', type=float, default=FAKE_TELEGRAM_LATENCIA)
+    r.add_argument('--latencia-notion', type=float, default=FAKE_NOTION_LATENCIA)
+    r = sub.add_parser('shards', help="Vazão com N workers atrás do router (processos) e rebalanceamento")
+    r.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    r.add_argument('--updates', type=int, default=4000)
+    r.add_argument('--chats', type=int, default=200)
+    r.add_argument('--clientes', type=int, default=64)
+    r.add_argument('--cpu', type=float, default=2, help="ms de CPU por update no handler")
+    r.add_argument('--porta', type=int, default=18600)
+    r = sub.add_parser('busca', help="Espelho local de chamados: custo da sync e latência da busca/leituras")
+    r.add_argument('--chamados', type=int, default=5000)
+    r.add_argument('--comentarios', type=int, default=20, help="observações por chamado")
+    r.add_argument('--clientes', type=int, default=100)
+    r.add_argument('--consultas', type=int, default=500)
+    r.add_argument('--latencia', type=float, default=0.0, help="latência do Notion falso (a sync completa faz uma chamada por chamado)")
+    r = sub.add_parser('analitico', help="Log de eventos: conferência das métricas e tempo do /relatorio com milhões de eventos")
+    r.add_argument('--eventos', type=int, default=2000000)
+    r.add_argument('--chats', type=int, default=500)
+    r.add_argument('--dias', type=int, default=90)
+    r = sub.add_parser('boot', help="Tempo do início do processo até o primeiro update atendido (frio x quente, rápido x bloqueante)")
+    r.add_argument('--clientes', type=int, default=2000)
+    r.add_argument('--latencia', type=float, default=0.3, help="latência do Notion falso (a sync completa pagina de 100 em 100)")
+    args = p.parse_args()
+    return asyncio.run(SCENARIOS[args.cenario](args))
+
+if __name__ == '__main__':
+    sys.exit(main())
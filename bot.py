@@ -1,19 +1,31 @@
 import logging
 import asyncio
 import pickle
+import json
+import io
 import os
 import re
 import time
+import heapq
+import hashlib
+import sqlite3
+import threading
+import bisect
+import array
+import functools
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import pytz
 import pathlib
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from notion_client import Client
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from telegram.error import RetryAfter, BadRequest, Forbidden, TimedOut, NetworkError
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.api_core import exceptions as google_exceptions
+# google.generativeai, notion_client e apscheduler são importados sob demanda (ver SDKs SOB DEMANDA)
 
 # --- CARREGA .ENV ---
 load_dotenv()
@@ -25,6 +37,9 @@ NOTION_TICKETS_DB_ID = os.getenv('NOTION_TICKETS_DB_ID')
 NOTION_CLIENTS_DB_ID = os.getenv('NOTION_CLIENTS_DB_ID')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 STATE_FILE = os.getenv('STATE_FILE', 'bot_state.pkl')
+STATE_JOURNAL = os.getenv('STATE_JOURNAL', f"{STATE_FILE}.log")
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'arquivo') # 'arquivo' (snapshot + journal) ou 'sqlite' (pode ser compartilhado entre workers)
+STATE_DB = os.getenv('STATE_DB', 'bot_state.db')
 
 try: ADMIN_ID = int(os.getenv('ADMIN_ID'))
 except: ADMIN_ID = 0
@@ -36,69 +51,722 @@ DIAS_UTEIS = [0, 1, 2, 3, 4]
 HORA_INICIO_EXPEDIENTE = 8
 HORA_FIM_EXPEDIENTE = 18
 MINUTOS_INATIVIDADE = 30 
+INATIVIDADE_RETENTATIVA_SEGUNDOS = 60 # fechamento por inatividade que falhou (ex.: timeout do Telegram) tenta de novo
 
 NUMERO_PLANTONISTA = "(11) 99999-9999"
 NOME_PLANTONISTA = "Daniel"
 
+# --- IA ---
+IA_MODELOS = ['gemini-2.0-flash', 'gemini-2.5-flash', 'gemini-flash-latest']
+IA_WORKERS = 3 # resumos gerados em paralelo
+IA_FALHAS_CIRCUITO = 3 # falhas seguidas antes de pausar o modelo
+IA_CIRCUITO_SEGUNDOS = 120
+IA_RODADAS = 3 # passadas por todos os modelos quando todos respondem 429
+IA_LATENCIA_INICIAL = 2.0 # segundos assumidos para um modelo ainda sem medição
+IA_JOB_TENTATIVAS = 5 # reprocessamentos de um resumo quando todos os modelos falham
+IA_JOB_ESPERA = 60 # segundos entre reprocessamentos
+IA_MAPREDUCE_CHARS = 20000 # logs maiores que isso são resumidos em partes (map-reduce)
+IA_MAPREDUCE_PARTE_CHARS = 12000
+IA_MAPREDUCE_PARALELO = 4 # partes resumidas ao mesmo tempo
+
+# --- CLIENTES ---
+CLIENTES_SYNC_COMPLETO_HORAS = 6 # sync completo periódico (pega clientes apagados no Notion)
+CLIENTES_CACHE_NEGATIVO_SEGUNDOS = 300 # tempo que um chat desconhecido fica sem disparar nova sync
+CLIENTES_SYNC_MARGEM_SEGUNDOS = 60 # a sync incremental relê o que mudou até 1 min antes do início da anterior
+
+# --- ÁUDIOS ---
+AUDIO_WORKERS = 2 # transcrições simultâneas
+AUDIO_FILA_MAX = 50
+AUDIO_MAX_ESPERA = 30 # segundos esperando o Google processar o arquivo
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'cache_transcricoes')
+AUDIO_CACHE_MEMORIA = 500 # transcrições mantidas em memória
+AUDIO_CACHE_DIAS = 30
+
+# --- AVISOS ---
+TELEGRAM_MSGS_POR_SEGUNDO = 25 # limite global do Telegram é ~30/s
+AVISO_CONCORRENCIA = 10
+AVISO_TENTATIVAS = 4
+AVISO_PROGRESSO_SEGUNDOS = 3
+AVISO_HISTORICO = 10 # execuções guardadas para /reaviso
+
+# --- FECHAMENTO AGENDADO ---
+FECHAMENTO_ALVO_SEGUNDOS = 60 # tempo desejado para fechar todos os grupos abertos
+FECHAMENTO_CONCORRENCIA_MIN = 5
+FECHAMENTO_CONCORRENCIA_MAX = 30
+FECHAMENTO_SEG_POR_GRUPO = 2.0 # estimativa inicial; depois usa a média medida nas varreduras
+FECHAMENTO_TENTATIVAS = 3
+FECHAMENTO_PROGRESSO_SEGUNDOS = 5
+
+# --- BUFFER NOTION ---
+OUTBOX_MAX_MSGS = 20 # mensagens acumuladas antes de enviar ao ticket
+OUTBOX_SEGUNDOS = 120 # idade máxima do buffer antes de enviar
+OUTBOX_VERIFICACAO_SEGUNDOS = 10
+
+# --- MENUS DE CHAMADOS ---
+CHAMADOS_CACHE_SEGUNDOS = 60 # validade da lista de chamados ativos por cliente
+CHAMADOS_POR_PAGINA = 8
+
+# --- HISTÓRICO ---
+HISTORICO_PAGINA_CHARS = 3500 # limite do Telegram é 4096 por mensagem
+HISTORICO_CACHE_TICKETS = 200
+HISTORICO_CACHE_MINUTOS = 10 # relê do Notion depois disso (pega edições feitas direto no Notion)
+
+# --- ESPELHO DE CHAMADOS ---
+ESPELHO_DB = os.getenv('ESPELHO_DB', 'chamados.db') # cópia local (SQLite + FTS5) dos chamados e comentários
+ESPELHO_SYNC_SEGUNDOS = 60 # intervalo da sync incremental (por last_edited_time)
+ESPELHO_SYNC_COMPLETO_HORAS = 24 # passada completa: remove do espelho o que foi apagado/arquivado no Notion
+ESPELHO_FRESCO_SEGUNDOS = 300 # sem sync bem-sucedida há mais que isso, as leituras voltam a ir ao Notion
+BUSCA_RESULTADOS = 10
+
+# --- ANALÍTICO ---
+ANALITICO_DIR = os.getenv('ANALITICO_DIR', 'analitico') # eventos em colunas binárias (uma subpasta por worker)
+ANALITICO_FLUSH_SEGUNDOS = 10
+ANALITICO_DIAS_PADRAO = 7 # período do /relatorio sem argumento
+ANALITICO_TOP_CLIENTES = 15
+
+# --- LOGS DE SESSÃO ---
+LOG_DIR = os.getenv('LOG_DIR', 'logs_sessao')
+LOG_FLUSH_SEGUNDOS = 1 # linhas acumuladas em memória antes de irem ao disco (em lote, fora do event loop)
+LOG_PROMPT_CHARS = 60000 # ~15k tokens: teto do log (ou das notas) no prompt do relatório
+
+# --- PERSISTÊNCIA ---
+STATE_FLUSH_DELAY = 0.5 # segundos para juntar escritas próximas num só lote
+STATE_COMPACT_RECORDS = 5000 # registros no journal antes de reescrever o snapshot
+
+# --- BOOT ---
+BOOT_RAPIDO = os.getenv('BOOT_RAPIDO', '1') == '1' # 1 = atende assim que o estado carrega; SDKs e sync do Notion em segundo plano
+BOOT_T0 = time.perf_counter() # referência das fases do boot (logo depois dos imports)
+
+# --- CONCORRÊNCIA ---
+MAX_UPDATES_SIMULTANEOS = 64 # updates de chats diferentes processados em paralelo
+MAX_UPDATES_ADMITIDOS = MAX_UPDATES_SIMULTANEOS * 16 # semáforo do PTB: updates em andamento, incluindo os que esperam o lock do chat
+TELEGRAM_CONEXOES = MAX_UPDATES_SIMULTANEOS * 4 # pool HTTP da Bot API: handlers em paralelo + jobs de fundo (no PTB antigo o padrão é 1)
+
+# --- WEBHOOK ---
+BOT_MODO = os.getenv('BOT_MODO', 'polling') # 'polling' ou 'webhook'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # URL pública (https) registrada no Telegram; vazia = não registra
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') # conferido no header X-Telegram-Bot-Api-Secret-Token; obrigatório em webhook, router e worker
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_FILA_MAX = 1000 # updates esperando processamento; acima disso responde 503 e o Telegram reenvia depois
+WEBHOOK_WORKERS = MAX_UPDATES_SIMULTANEOS
+WEBHOOK_CONEXOES = 40 # conexões simultâneas que o Telegram abre para o webhook
+
+# --- SHARDING ---
+SHARD_MODO = os.getenv('SHARD_MODO', '') # vazio = processo único; 'router' ou 'worker'
+SHARD_WORKERS = [w.strip().rstrip('/') for w in os.getenv('SHARD_WORKERS', '').split(',') if w.strip()] # URLs base dos workers
+SHARD_ID = os.getenv('SHARD_ID', '').rstrip('/') # URL deste worker, igual à que aparece em SHARD_WORKERS
+SHARD_VNODES = 256 # pontos de cada worker no anel (mais pontos = divisão mais uniforme)
+SHARD_SAUDE_SEGUNDOS = 5 # intervalo do health check do router
+SHARD_TIMEOUT = 10
+
+# --- LIMITES NOTION ---
+NOTION_MAX_CONEXOES = 10
+NOTION_MAX_CONCORRENCIA = 3
+NOTION_MAX_TENTATIVAS = 3
+
+# --- MÉTRICAS ---
+METRICAS_HOST = os.getenv('METRICAS_HOST', '127.0.0.1')
+METRICAS_PORTA = int(os.getenv('METRICAS_PORTA', '0')) # 0 = sem endpoint HTTP (só /metricas)
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # segundos
+
+# --- SDKs SOB DEMANDA ---
+# Só o import do google.generativeai leva ~0,7s; com notion_client e apscheduler passa de 0,9s por boot.
+# genai e notion são proxies que importam/constroem o objeto real no primeiro acesso a um atributo; logo depois
+# do boot, warm_sdks faz isso numa thread para o primeiro uso no event loop já encontrar tudo pronto.
+class LazyObject:
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None: self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+def load_genai():
+    import google.generativeai as module
+    if GEMINI_API_KEY: module.configure(api_key=GEMINI_API_KEY)
+    return module
+
+def load_notion():
+    from notion_client import AsyncClient
+    return AsyncClient(auth=NOTION_TOKEN, client=notion_http)
+
+def notion_api_error():
+    # Só aparece em cláusulas except, que são avaliadas quando já há exceção: não força o import no boot
+    from notion_client import APIResponseError
+    return APIResponseError
+
+def warm_sdks():
+    t0 = time.perf_counter()
+    import notion_client, apscheduler.schedulers.asyncio # noqa: F401
+    for lazy in (notion, genai):
+        if isinstance(lazy, LazyObject): lazy._load() # pode ter sido trocado (benchmark)
+    return time.perf_counter() - t0
+
 # Setup
-notion = Client(auth=NOTION_TOKEN)
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+notion_http = httpx.AsyncClient(limits=httpx.Limits(max_connections=NOTION_MAX_CONEXOES, max_keepalive_connections=NOTION_MAX_CONEXOES), timeout=httpx.Timeout(30.0))
+notion = LazyObject(load_notion)
+notion_sem = asyncio.Semaphore(NOTION_MAX_CONCORRENCIA)
+genai = LazyObject(load_genai)
 
 # CONSTANTES
 WAITING_NEW_TICKET = 1 
 WAITING_COMMENT = 2    
 
 # MEMÓRIA
-CLIENT_GROUPS = {} 
-user_states = {}   
-last_activity = {} 
-group_status = {}  
-session_logs = {}       
-active_ticket_session = {} 
-ticket_first_session = {} 
+# Os dicts persistidos anotam as chaves alteradas; save_state_async grava só essas chaves no journal.
+# Se um valor for alterado "por dentro" (sem atribuição), chame .touch(chave).
+state_dirty = {}
+
+class TrackedDict(dict):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+    def __setitem__(self, k, v):
+        super().__setitem__(k, v)
+        state_dirty[(self.name, k)] = None
+    def __delitem__(self, k):
+        super().__delitem__(k)
+        state_dirty[(self.name, k)] = None
+    def touch(self, k): state_dirty[(self.name, k)] = None
+    def pop(self, k, *default):
+        if k in self: state_dirty[(self.name, k)] = None
+        return super().pop(k, *default)
+    def setdefault(self, k, default=None):
+        if k not in self: self[k] = default
+        return self[k]
+    def update(self, *a, **kw):
+        for k, v in dict(*a, **kw).items(): self[k] = v
+    def clear(self):
+        for k in list(self): del self[k]
+    def replace(self, new):
+        # Troca o conteúdo inteiro anotando só as diferenças
+        for k in [k for k in self if k not in new]: del self[k]
+        for k, v in new.items():
+            if k not in self or self[k] != v: self[k] = v
+
+CLIENT_GROUPS = TrackedDict('CLIENT_GROUPS')
+user_states = TrackedDict('user_states')
+last_activity = TrackedDict('last_activity')
+group_status = TrackedDict('group_status')
+active_ticket_session = TrackedDict('active_ticket_session')
+ticket_first_session = TrackedDict('ticket_first_session')
 prompt_messages = {}
+ticket_pages = TrackedDict('ticket_pages') # ticket_id -> page_id do Notion
+summary_jobs = TrackedDict('summary_jobs') # resumos IA pendentes (sobrevivem a restart)
+notion_outbox = TrackedDict('notion_outbox') # ticket_id -> {'first_at', 'items': [(ts, user, texto)]} ainda não enviados
+broadcast_runs = TrackedDict('broadcast_runs') # run_id -> {'msg', 'sent', 'failed': {chat_id: erro}}
+client_pages = TrackedDict('client_pages') # page_id do cliente no Notion -> chat_id
+bot_meta = TrackedDict('bot_meta') # marcas diversas (última sync de clientes, ...)
+
+STATE_DICTS = {d.name: d for d in (CLIENT_GROUPS, user_states, last_activity, group_status, active_ticket_session, ticket_first_session, ticket_pages, summary_jobs, notion_outbox, broadcast_runs, client_pages, bot_meta)}
+# Sharding: estado por chat (chave -> chat_id) fica só no worker dono do chat; filas de trabalho são de cada worker
+CHAT_STATE = {'user_states': lambda k: int(k.split('_')[1]), 'last_activity': int, 'group_status': int, 'active_ticket_session': int}
+WORKER_STATE = ('summary_jobs', 'notion_outbox', 'broadcast_runs')
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- PERSISTÊNCIA ASSÍNCRONA ---
-async def save_state_async():
-    data = {
-        'CLIENT_GROUPS': CLIENT_GROUPS, 
-        'user_states': user_states, 
-        'last_activity': last_activity, 
-        'group_status': group_status,
-        'active_ticket_session': active_ticket_session,
-        'ticket_first_session': ticket_first_session
-    }
+# --- LOGS DE SESSÃO ---
+# Disco é a fonte da verdade: um arquivo JSON-lines por chat em LOG_DIR (sobrevive a restart).
+# log_append só acumula em memória; as linhas vão para o disco em lote a cada LOG_FLUSH_SEGUNDOS, fora do event loop.
+# Toda operação nos arquivos (gravar lote, apagar, congelar, ler para o resumo) passa pelo mesmo executor de uma
+# thread: a ordem de chegada é a ordem de execução, então um lote atrasado nunca cai na sessão seguinte do chat.
+session_log_counts = {}
+session_log_pending = {} # chat_id -> linhas ainda não gravadas
+session_log_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='logs_sessao')
+session_log_task = None
+
+def session_log_path(name):
+    return os.path.join(LOG_DIR, f"{name}.log")
+
+def session_log_io_call(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(session_log_io, fn, *args)
+
+def write_log_lines(path, lines):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f: f.write("".join(json.dumps(l, ensure_ascii=False) + "\n" for l in lines))
+
+def write_log_batch(batch):
+    for chat_id, lines in batch.items():
+        try: write_log_lines(session_log_path(chat_id), lines)
+        except OSError as e: logger.error(f"Erro log {chat_id}: {e}")
+
+def remove_log_file(path):
+    try: os.remove(path)
+    except OSError: pass
+
+def freeze_log_file(src, dst, lines):
     try:
-        await asyncio.to_thread(write_pickle, data)
-    except Exception as e: logger.error(f"Erro save async: {e}")
+        if lines: write_log_lines(src, lines)
+        os.replace(src, dst)
+    except OSError as e: logger.error(f"Erro ao congelar log {src}: {e}")
+
+async def flush_session_logs():
+    global session_log_pending
+    if not session_log_pending: return
+    batch, session_log_pending = session_log_pending, {}
+    await session_log_io_call(write_log_batch, batch)
 
-def write_pickle(data):
-    with open(STATE_FILE, 'wb') as f: pickle.dump(data, f)
+async def session_log_loop():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_SEGUNDOS)
+        await flush_session_logs()
+
+def start_session_log_flusher():
+    global session_log_task
+    session_log_task = asyncio.create_task(session_log_loop())
+
+def log_reset(chat_id):
+    session_log_counts.pop(chat_id, None)
+    session_log_pending.pop(chat_id, None)
+    session_log_io.submit(remove_log_file, session_log_path(chat_id))
+
+def log_append(chat_id, line):
+    session_log_pending.setdefault(chat_id, []).append(line)
+    session_log_counts[chat_id] = session_log_counts.get(chat_id, 0) + 1
+
+def log_count(chat_id):
+    return session_log_counts.get(chat_id, 0)
+
+def read_log_file(path):
+    # Crash no meio de um lote deixa a última linha pela metade: ela é descartada, o resto do atendimento não
+    lines, bad = [], 0
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for l in f:
+                if not l.strip(): continue
+                try: lines.append(json.loads(l))
+                except ValueError: bad += 1
+    except OSError: return []
+    if bad: logger.warning(f"Log {path}: {bad} linha(s) corrompida(s) ignorada(s)")
+    return lines
+
+def log_freeze(chat_id, name):
+    # Congela o log do atendimento com outro nome (para a fila de resumo) e libera o chat;
+    # as linhas ainda em memória entram no arquivo antes da troca de nome
+    path = None
+    if log_count(chat_id):
+        path = session_log_path(name)
+        session_log_io.submit(freeze_log_file, session_log_path(chat_id), path, session_log_pending.pop(chat_id, None))
+    session_log_counts.pop(chat_id, None)
+    return path
+
+def load_session_log(chat_id):
+    path = session_log_path(chat_id)
+    lines = read_log_file(path)
+    if lines: session_log_counts[chat_id] = len(lines)
+    # Fecha a linha cortada por um crash para o próximo lote não grudar nela
+    try:
+        with open(path, 'rb+') as f:
+            if f.seek(0, os.SEEK_END) == 0: return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': f.write(b'\n')
+    except OSError: pass
+
+def load_session_logs():
+    # Restart: reconta as linhas em disco dos chats ainda abertos (o resto é log órfão)
+    if not os.path.isdir(LOG_DIR): return
+    for entry in os.scandir(LOG_DIR):
+        try: chat_id = int(entry.name[:-4])
+        except ValueError: continue
+        if not owns_chat(chat_id): continue # LOG_DIR compartilhado: o log é do worker dono
+        try:
+            if group_status.get(chat_id) != 'OPEN':
+                os.remove(entry.path)
+                continue
+            load_session_log(chat_id)
+        except Exception as e: logger.error(f"Erro ao carregar log {entry.name}: {e}")
+
+def log_export_chunks(lines, budget_chars=None):
+    # Quebra o log em blocos de até budget_chars (~4 chars por token) sem cortar linhas
+    budget_chars = budget_chars or LOG_PROMPT_CHARS
+    chunks, cur, size = [], [], 0
+    for line in lines:
+        line = line[:budget_chars]
+        if cur and size + len(line) + 1 > budget_chars:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        cur.append(line)
+        size += len(line) + 1
+    if cur: chunks.append("\n".join(cur))
+    return chunks
+
+# --- PERSISTÊNCIA INCREMENTAL ---
+# Os lotes de chaves alteradas vão para o backend de estado (STATE_BACKEND):
+# - arquivo: STATE_FILE é o snapshot completo; STATE_JOURNAL recebe os lotes. load = snapshot + replay do journal;
+#   a compactação reescreve o snapshot e zera o journal.
+# - sqlite: uma linha por chave em STATE_DB (WAL). Vários workers podem usar o mesmo arquivo; os dicts de
+#   WORKER_STATE ficam separados por worker.
+state_lock = asyncio.Lock()
+state_flush_task = None
+state_journal_records = 0
+state_stats = {'saves': 0, 'flushes': 0, 'records': 0, 'bytes': 0, 'compactions': 0, 'since': time.monotonic()}
+
+async def save_state_async():
+    # Só agenda: chamadas próximas caem no mesmo lote
+    global state_flush_task
+    state_stats['saves'] += 1
+    if state_flush_task is None or state_flush_task.done():
+        state_flush_task = asyncio.create_task(delayed_flush())
+
+async def delayed_flush():
+    await asyncio.sleep(STATE_FLUSH_DELAY)
+    await flush_state()
+
+async def flush_state():
+    global state_journal_records
+    async with state_lock:
+        if not state_dirty: return
+        ops = []
+        for name, k in list(state_dirty):
+            d = STATE_DICTS[name]
+            if k in d: ops.append(('set', name, k, d[k]))
+            else: ops.append(('del', name, k, None))
+        state_dirty.clear()
+        try:
+            # Serializa no loop (consistente) e escreve na thread
+            blob = pickle.dumps(ops)
+            await asyncio.to_thread(state_backend.write, blob)
+            state_journal_records += len(ops)
+            state_stats['flushes'] += 1
+            state_stats['records'] += len(ops)
+            state_stats['bytes'] += len(blob)
+        except Exception as e:
+            logger.error(f"Erro save journal: {e}")
+            for op in ops: state_dirty[(op[1], op[2])] = None
+            return
+    if state_journal_records >= STATE_COMPACT_RECORDS: asyncio.create_task(compact_state())
+
+async def compact_state():
+    global state_journal_records
+    async with state_lock:
+        try:
+            # Serializa no loop (consistente) e escreve na thread
+            blob = pickle.dumps({name: dict(d) for name, d in STATE_DICTS.items()})
+            await asyncio.to_thread(state_backend.compact, blob)
+            state_journal_records = 0
+            state_stats['compactions'] += 1
+        except Exception as e: logger.error(f"Erro compactação: {e}")
+
+def append_journal(blob):
+    with open(STATE_JOURNAL, 'ab') as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_atomic(path, blob):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def write_snapshot(blob):
+    write_atomic(STATE_FILE, blob)
+    # Journal já está contido no snapshot; se cair antes daqui, o replay é idempotente
+    with open(STATE_JOURNAL, 'wb'): pass
+
+class FileStateBackend:
+    def write(self, blob): append_journal(blob)
+
+    def compact(self, blob): write_snapshot(blob)
+
+    def load(self):
+        # Retorna (snapshot, operações do journal)
+        data, ops = {}, []
+        if os.path.exists(STATE_FILE):
+            try:
+                with open(STATE_FILE, 'rb') as f: data = pickle.load(f)
+            except Exception as e: logger.error(f"Erro load snapshot: {e}")
+        if os.path.exists(STATE_JOURNAL):
+            with open(STATE_JOURNAL, 'rb') as f:
+                while True:
+                    try: ops.extend(pickle.load(f))
+                    except EOFError: break
+                    except Exception: 
+                        logger.warning("Journal com final truncado, ignorando resto.")
+                        break
+        return data, ops
+
+class SqliteStateBackend:
+    def __init__(self, path, worker=''):
+        self.path = path
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.db = None
+
+    def conn(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state (name TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, PRIMARY KEY (name, key))")
+        return self.db
+
+    def table(self, name):
+        # Filas de trabalho ficam com o worker que as criou (ex.: 'summary_jobs@http://w1:8443')
+        return f"{name}@{self.worker}" if self.worker and name in WORKER_STATE else name
+
+    def write(self, blob):
+        ops = pickle.loads(blob)
+        with self.lock, self.conn() as db:
+            db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", [(self.table(n), pickle.dumps(k), pickle.dumps(v)) for op, n, k, v in ops if op == 'set'])
+            db.executemany("DELETE FROM state WHERE name = ? AND key = ?", [(self.table(n), pickle.dumps(k)) for op, n, k, v in ops if op == 'del'])
+
+    def compact(self, blob):
+        # Cada chave já é uma linha: só devolve o WAL ao banco
+        with self.lock: self.conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def load(self):
+        data = {}
+        with self.lock:
+            for name in STATE_DICTS:
+                rows = self.conn().execute("SELECT key, value FROM state WHERE name = ?", (self.table(name),)).fetchall()
+                data[name] = {pickle.loads(k): pickle.loads(v) for k, v in rows}
+        return data, []
+
+state_backend = SqliteStateBackend(STATE_DB, SHARD_ID) if STATE_BACKEND == 'sqlite' else FileStateBackend()
 
 def load_state():
-    global CLIENT_GROUPS, user_states, last_activity, group_status, active_ticket_session, ticket_first_session
-    if not os.path.exists(STATE_FILE): return
+    global state_journal_records
+    data, ops = state_backend.load()
+    for name, d in STATE_DICTS.items():
+        if name in data: dict.update(d, data[name])
+    for op, name, k, v in ops:
+        d = STATE_DICTS.get(name)
+        if d is None: continue
+        if op == 'set': dict.__setitem__(d, k, v)
+        else: dict.pop(d, k, None)
+        state_journal_records += 1
+    drop_foreign_chats()
+    state_dirty.clear()
+
+def state_rates():
+    elapsed = max(time.monotonic() - state_stats['since'], 1e-9)
+    return {k: state_stats[k] / elapsed for k in ('saves', 'flushes', 'records', 'bytes')}
+
+# --- MÉTRICAS ---
+# Histogramas de latência e contadores em memória, no formato do Prometheus (texto em /metrics).
+# Chave: (nome, ((rótulo, valor), ...)). Os buckets guardam contagens por faixa; a exportação acumula.
+metric_hists = {}
+metric_counters = {}
+metrics_server = None
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def metric_observe(name, seconds, **labels):
+    key = metric_key(name, labels)
+    h = metric_hists.get(key)
+    if h is None: h = metric_hists[key] = {'buckets': [0] * (len(METRICAS_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+    h['buckets'][bisect.bisect_left(METRICAS_BUCKETS, seconds)] += 1
+    h['sum'] += seconds
+    h['count'] += 1
+
+def metric_count(name, n=1, **labels):
+    key = metric_key(name, labels)
+    metric_counters[key] = metric_counters.get(key, 0) + n
+
+@asynccontextmanager
+async def timed(name, **labels):
+    # Mede o bloco; exceções contam em <nome sem _segundos>_erros_total e seguem adiante
+    t0 = time.perf_counter()
+    try: yield
+    except Exception as e:
+        metric_count(name.removesuffix('_segundos') + '_erros_total', erro=type(e).__name__, **labels)
+        raise
+    finally: metric_observe(name, time.perf_counter() - t0, **labels)
+
+def instrumented(label):
+    # Decorador de handler; label é fixo ou calculado a partir do update
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            async with timed('bot_handler_segundos', handler=label(update) if callable(label) else label):
+                return await fn(update, context)
+        return wrapper
+    return decorator
+
+def hist_quantile(h, q):
+    # Estimativa por interpolação linear dentro do bucket, como o histogram_quantile do Prometheus
+    if not h['count']: return None
+    rank, seen, lower = q * h['count'], 0, 0.0
+    for i, n in enumerate(h['buckets']):
+        upper = METRICAS_BUCKETS[i] if i < len(METRICAS_BUCKETS) else METRICAS_BUCKETS[-1]
+        if n and seen + n >= rank: return lower + (upper - lower) * (rank - seen) / n
+        seen += n
+        lower = upper
+    return METRICAS_BUCKETS[-1]
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{prometheus_escape(v)}"' for k, v in items) + "}"
+
+def metrics_prometheus():
+    lines, typed = [], set()
+    for (name, labels), h in sorted(metric_hists.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        acc = 0
+        for i, n in enumerate(h['buckets']):
+            acc += n
+            le = str(METRICAS_BUCKETS[i]) if i < len(METRICAS_BUCKETS) else "+Inf"
+            lines.append(f"{name}_bucket{prometheus_labels(labels, [('le', le)])} {acc}")
+        lines.append(f"{name}_sum{prometheus_labels(labels)} {h['sum']:.6f}")
+        lines.append(f"{name}_count{prometheus_labels(labels)} {h['count']}")
+    for (name, labels), n in sorted(metric_counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{prometheus_labels(labels)} {n}")
+    return "\n".join(lines) + "\n"
+
+def metrics_summary_text(top=8):
+    # Resumo para /metricas: os rótulos com mais tempo acumulado em cada grupo
+    groups = [("Handlers", 'bot_handler_segundos'), ("Notion", 'bot_notion_segundos'), ("Gemini", 'bot_gemini_segundos'), ("Telegram", 'bot_telegram_segundos')]
+    out = []
+    for title, name in groups:
+        rows = sorted(((h['sum'], labels, h) for (n, labels), h in metric_hists.items() if n == name), reverse=True)[:top]
+        out.append(f"{title}:")
+        if not rows: out.append("  -")
+        for total, labels, h in rows:
+            label = ",".join(str(v) for _, v in labels)
+            errors = sum(c for (n, lb), c in metric_counters.items() if n == name.removesuffix('_segundos') + '_erros_total' and set(labels) <= set(lb))
+            out.append(f"  {label}: {h['count']}x | p50 {hist_quantile(h, 0.5) * 1000:.0f}ms | p95 {hist_quantile(h, 0.95) * 1000:.0f}ms | total {total:.1f}s | erros {errors}")
+    retries = [(name, ",".join(str(v) for _, v in labels), n) for (name, labels), n in sorted(metric_counters.items()) if 'retentativas' in name]
+    if retries: out.append("Retentativas:\n" + "\n".join(f"  {name.split('_')[1]} {label}: {n}" for name, label, n in retries))
+    return "\n".join(out)
+
+async def handle_metrics_request(reader, writer):
+    # HTTP mínimo (só GET /metrics), sem depender de servidor web no modo polling
     try:
-        with open(STATE_FILE, 'rb') as f:
-            data = pickle.load(f)
-            if 'CLIENT_GROUPS' in data: CLIENT_GROUPS = data['CLIENT_GROUPS']
-            if 'user_states' in data: user_states = data['user_states']
-            if 'last_activity' in data: last_activity = data['last_activity']
-            if 'group_status' in data: group_status = data['group_status']
-            if 'active_ticket_session' in data: active_ticket_session = data['active_ticket_session']
-            if 'ticket_first_session' in data: ticket_first_session = data['ticket_first_session']
-    except: pass
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+        path = request_line.split()[1] if len(request_line.split()) > 1 else b""
+        if path == b"/metrics": status, body = "200 OK", metrics_prometheus().encode()
+        else: status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception: pass
+    finally: writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICAS_PORTA: metrics_server = await asyncio.start_server(handle_metrics_request, METRICAS_HOST, METRICAS_PORTA)
+
+class MetricsRequest(HTTPXRequest):
+    # Cliente HTTP do bot com tempo por método da Bot API (sendMessage, editMessageText, ...)
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        async with timed('bot_telegram_segundos', metodo=endpoint):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        if code >= 400: metric_count('bot_telegram_erros_total', metodo=endpoint, erro=str(code))
+        return code, payload
 
 # --- FUNÇÕES IA ---
-def generate_ai_analysis(messages, current_desc, is_first_session, closing_reason="manual"):
+# Roteador de modelos: handles reaproveitados e estatística por modelo (latência, erros, 429).
+# Cada chamada tenta primeiro o modelo mais saudável; depois de IA_FALHAS_CIRCUITO falhas seguidas
+# o modelo fica em pausa (circuit breaker) por IA_CIRCUITO_SEGUNDOS.
+model_handles = {}
+model_stats = {}
+
+def get_model(model_name):
+    model = model_handles.get(model_name)
+    if model is None: model = model_handles[model_name] = genai.GenerativeModel(model_name)
+    return model
+
+def model_stat(model_name):
+    return model_stats.setdefault(model_name, {'calls': 0, 'ok': 0, 'errors': 0, 'rate_limited': 0, 'latency': None, 'fails': 0, 'open_until': 0})
+
+def circuit_is_open(model_name):
+    return model_stat(model_name)['open_until'] > time.monotonic()
+
+def model_record(model_name, ok, latency=None, rate_limited=False):
+    st = model_stat(model_name)
+    st['calls'] += 1
+    if ok:
+        st['ok'] += 1
+        st['fails'] = 0
+        # Média móvel exponencial da latência
+        st['latency'] = latency if st['latency'] is None else 0.8 * st['latency'] + 0.2 * latency
+        return
+    if rate_limited: st['rate_limited'] += 1
+    else: st['errors'] += 1
+    st['fails'] += 1
+    if st['fails'] >= IA_FALHAS_CIRCUITO:
+        st['open_until'] = time.monotonic() + IA_CIRCUITO_SEGUNDOS
+        logger.warning(f"Circuito aberto para {model_name} por {IA_CIRCUITO_SEGUNDOS}s")
+
+def model_score(model_name):
+    # Menor é melhor: latência penalizada pela taxa de falhas (com suavização para modelos pouco usados)
+    st = model_stat(model_name)
+    if circuit_is_open(model_name): return float('inf')
+    fail_rate = (st['errors'] + st['rate_limited']) / (st['calls'] + 2)
+    latency = st['latency'] if st['latency'] is not None else IA_LATENCIA_INICIAL
+    return latency * (1 + 4 * fail_rate)
+
+def ranked_models():
+    # sorted é estável: em empate vale a ordem de IA_MODELOS
+    return sorted(IA_MODELOS, key=model_score)
+
+async def route_generate(contents):
+    # Retorna (texto, erro). Num 429 passa direto ao próximo modelo; só espera se todos recusarem.
+    last_error = ""
+    for attempt in range(IA_RODADAS):
+        all_rate_limited = True
+        for model_name in ranked_models():
+            if circuit_is_open(model_name):
+                last_error = f"{model_name} em pausa"
+                continue
+            t0 = time.monotonic()
+            try:
+                async with timed('bot_gemini_segundos', modelo=model_name):
+                    response = await get_model(model_name).generate_content_async(contents)
+                model_record(model_name, True, time.monotonic() - t0)
+                return response.text, None
+            except Exception as e:
+                last_error = str(e)
+                is_429 = "429" in last_error
+                all_rate_limited = all_rate_limited and is_429
+                model_record(model_name, False, rate_limited=is_429)
+        if not all_rate_limited: break
+        metric_count('bot_gemini_retentativas_total', motivo="429")
+        await asyncio.sleep(2 ** attempt)
+    return None, last_error
+
+def model_stats_text():
+    lines = []
+    for model_name in ranked_models():
+        st = model_stat(model_name)
+        calls = max(st['calls'], 1)
+        lat = f"{st['latency'] * 1000:.0f}ms" if st['latency'] is not None else "-"
+        pause = " | ⏸ pausa" if circuit_is_open(model_name) else ""
+        lines.append(f"{model_name}: {st['calls']} chamadas | {lat} | erros {st['errors'] / calls:.0%} | 429 {st['rate_limited'] / calls:.0%}{pause}")
+    return "\n".join(lines)
+
+async def generate_ai_analysis(messages, current_desc, is_first_session, closing_reason="manual", mode=None):
+    # mode: 'single' (log inteiro num prompt), 'mapreduce' (partes em paralelo + relatório final) ou None (automático)
     if not GEMINI_API_KEY or not messages: return None
     
-    models_to_try = ['gemini-2.0-flash', 'gemini-2.5-flash', 'gemini-flash-latest']
     chat_history = "\n".join(messages)
+    if mode is None: mode = 'mapreduce' if len(chat_history) > IA_MAPREDUCE_CHARS else 'single'
+    if mode == 'mapreduce':
+        chat_history, error = await map_reduce_log(messages)
+        if error: return error
     
     instruction_title = ""
     if is_first_session:
@@ -128,72 +796,302 @@ def generate_ai_analysis(messages, current_desc, is_first_session, closing_reaso
         "🏁 SITUAÇÃO ATUAL\n[Status]\n\n"
         f"--- LOG (NÃO COPIAR) ---\n{chat_history}"
     )
+    return await generate_text(prompt)
 
-    last_error = ""
-    for model_name in models_to_try:
-        try:
-            model = genai.GenerativeModel(model_name)
-            for attempt in range(3):
-                try:
-                    response = model.generate_content(prompt)
-                    return response.text
-                except Exception as e:
-                    if "429" in str(e):
-                        time.sleep(2)
-                        continue
-                    else: raise e
-        except Exception as e:
-            last_error = str(e)
-            continue 
-    return f"IA Indisponível: {last_error}"
+async def map_reduce_log(messages):
+    # Map: resume as partes do log em paralelo. Reduce: se as notas ainda não cabem no prompt final,
+    # repete sobre as notas. O relatório final (com as tags) é sempre gerado pelo prompt normal.
+    parts = log_export_chunks(messages, IA_MAPREDUCE_PARTE_CHARS)
+    sem = asyncio.Semaphore(IA_MAPREDUCE_PARALELO)
+
+    async def summarize_part(i, total, part):
+        prompt = (
+            "Você está resumindo UMA PARTE de um atendimento técnico ISP longo.\n"
+            "Extraia em tópicos curtos: problema relatado, testes, ações, pendências e quem fez o quê.\n"
+            "Se o cliente confirmar que foi resolvido (ou negar), copie a frase LITERALMENTE.\n"
+            "Responda só com os tópicos.\n\n"
+            f"--- PARTE {i}/{total} ---\n{part}"
+        )
+        async with sem: return await generate_text(prompt)
+
+    level = 0
+    while True:
+        level += 1
+        notes = await asyncio.gather(*(summarize_part(i, len(parts), p) for i, p in enumerate(parts, 1)))
+        failed = next((n for n in notes if n.startswith("IA Indisponível")), None)
+        if failed: return None, failed
+        merged = "\n\n".join(f"[PARTE {i}/{len(notes)}]\n{n}" for i, n in enumerate(notes, 1))
+        next_parts = log_export_chunks(merged.split("\n\n"), IA_MAPREDUCE_PARTE_CHARS)
+        if len(merged) <= LOG_PROMPT_CHARS or len(next_parts) >= len(parts):
+            return f"(Log longo resumido em {len(parts)} partes, {level} nível(is))\n{merged[:LOG_PROMPT_CHARS]}", None
+        parts = next_parts
+
+async def generate_text(prompt):
+    text, error = await route_generate(prompt)
+    return text if error is None else f"IA Indisponível: {error}"
 
-def transcribe_audio(file_path):
-    if not GEMINI_API_KEY: return "Erro: Sem Chave API"
+async def transcribe_audio(audio):
+    # Retorna (texto, ok); só ok=True é transcrição de verdade (e pode ir para o cache)
+    if not GEMINI_API_KEY: return "Erro: Sem Chave API", False
     try:
-        myfile = genai.upload_file(file_path, mime_type="audio/ogg")
-        timeout = 0
+        # SDK do Gemini é síncrono para upload/consulta: roda em thread, direto da memória (sem arquivo temporário)
+        myfile = await asyncio.to_thread(genai.upload_file, io.BytesIO(audio), mime_type="audio/ogg")
+        waited, delay = 0, 0.5
         while myfile.state.name == "PROCESSING":
-            time.sleep(1)
-            timeout += 1
-            myfile = genai.get_file(myfile.name)
-            if timeout > 30: return "Timeout Google."
-        if myfile.state.name == "FAILED": return "Google falhou."
-
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        for attempt in range(3):
-            try:
-                result = model.generate_content(["Transcreva fielmente:", myfile])
-                return result.text
-            except Exception as e:
-                if "429" in str(e): time.sleep(2); continue
-                else: return f"Erro IA: {str(e)}"
-        return "Cota IA excedida."
-    except Exception as e: return f"Erro Técnico: {str(e)}"
+            if waited > AUDIO_MAX_ESPERA: return "Timeout Google.", False
+            await asyncio.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 4)
+            myfile = await asyncio.to_thread(genai.get_file, myfile.name)
+        if myfile.state.name == "FAILED": return "Google falhou.", False
+
+        text, error = await route_generate(["Transcreva fielmente:", myfile])
+        if error is None: return text, True
+        return ("Cota IA excedida." if "429" in error else f"Erro IA: {error}"), False
+    except Exception as e: return f"Erro Técnico: {str(e)}", False
+
+# --- CACHE DE TRANSCRIÇÕES ---
+# Chave = file_unique_id do Telegram (mesmo áudio encaminhado/reenviado tem o mesmo id).
+# LRU em memória limitado por AUDIO_CACHE_MEMORIA, com cópia em disco (um arquivo por áudio) e TTL.
+transcription_cache = OrderedDict() # file_unique_id -> (expira_em, texto)
+
+def transcription_cache_path(key):
+    return os.path.join(AUDIO_CACHE_DIR, re.sub(r'[^A-Za-z0-9_-]', '_', key) + '.txt')
+
+def remember_transcription(key, expires, text):
+    transcription_cache[key] = (expires, text)
+    transcription_cache.move_to_end(key)
+    while len(transcription_cache) > AUDIO_CACHE_MEMORIA: transcription_cache.popitem(last=False)
+
+def read_transcription_file(key):
+    path = transcription_cache_path(key)
+    try:
+        expires = os.path.getmtime(path) + AUDIO_CACHE_DIAS * 86400
+        if expires < time.time():
+            os.remove(path)
+            return None
+        with open(path, 'r', encoding='utf-8') as f: return expires, f.read()
+    except OSError: return None
+
+def write_transcription_file(key, text):
+    os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+    write_atomic(transcription_cache_path(key), text.encode('utf-8'))
+
+def prune_transcription_files():
+    if not os.path.isdir(AUDIO_CACHE_DIR): return
+    limit = time.time() - AUDIO_CACHE_DIAS * 86400
+    for entry in os.scandir(AUDIO_CACHE_DIR):
+        try:
+            if entry.stat().st_mtime < limit: os.remove(entry.path)
+        except OSError: pass
+
+async def prune_transcription_cache():
+    await asyncio.to_thread(prune_transcription_files)
+
+async def get_cached_transcription(key):
+    hit = transcription_cache.get(key)
+    if hit:
+        if hit[0] > time.time():
+            transcription_cache.move_to_end(key)
+            return hit[1]
+        del transcription_cache[key]
+    hit = await asyncio.to_thread(read_transcription_file, key)
+    if not hit: return None
+    remember_transcription(key, *hit)
+    return hit[1]
+
+async def store_transcription(key, text):
+    remember_transcription(key, time.time() + AUDIO_CACHE_DIAS * 86400, text)
+    try: await asyncio.to_thread(write_transcription_file, key, text)
+    except Exception as e: logger.error(f"Erro cache transcrição: {e}")
+
+# --- FILA DE ÁUDIOS ---
+audio_queue = asyncio.Queue(maxsize=AUDIO_FILA_MAX)
+audio_workers = []
+
+async def transcribe_voice(update, context, status_msg, transcription=None):
+    # Retorna o texto que entra no log (transcrição ou aviso de erro); `transcription` vindo do cache é sempre sucesso
+    try:
+        ok = transcription is not None
+        if transcription is None:
+            new_file = await context.bot.get_file(update.message.voice.file_id)
+            audio = bytes(await new_file.download_as_bytearray())
+            
+            transcription, ok = await transcribe_audio(audio)
+            if ok and transcription:
+                await store_transcription(update.message.voice.file_unique_id, transcription)
+        
+        if ok and transcription:
+            text_content = transcription 
+            safe_transcription = sanitize_notion_text(transcription)
+            await status_msg.edit_text(f"🎙️ **Transcrição:**\n_{safe_transcription}_", parse_mode='Markdown')
+        else:
+            error_msg = transcription if transcription else "Erro desconhecido"
+            text_content = f"[Áudio enviado ({error_msg})]"
+            await status_msg.edit_text(f"⚠️ {error_msg}")
+        
+    except Exception as e:
+        logger.error(f"Erro audio: {e}")
+        text_content = "[Áudio enviado (Erro processamento)]"
+        await status_msg.edit_text("⚠️ Erro ao processar áudio.")
+    
+    return text_content
+
+async def audio_worker():
+    while True:
+        update, context, status_msg = await audio_queue.get()
+        try:
+            # Transcreve fora do lock do chat; só a parte que mexe no estado espera a vez
+            text_content = await transcribe_voice(update, context, status_msg)
+            async with chat_lock(update.effective_chat.id): await handle_content(update, context, text_content)
+        except Exception as e: logger.error(f"Erro fila audio: {e}")
+        finally: audio_queue.task_done()
+
+def start_audio_workers():
+    asyncio.create_task(prune_transcription_cache())
+    for _ in range(AUDIO_WORKERS): audio_workers.append(asyncio.create_task(audio_worker()))
+
+# --- NOTION GATEWAY ---
+# Todas as chamadas ao Notion passam por aqui: pool HTTP compartilhado + limite de concorrência.
+NOTION_RETRY_CODES = ('rate_limited', 'internal_server_error', 'service_unavailable') # valores de notion_client.APIErrorCode (str)
+# Criação (pages.create, blocks.children.append) pode ter dado certo no Notion mesmo com timeout/5xx: repetir duplica
+# a página ou o bloco. Sem idempotência, só repete o que com certeza não chegou lá (429, conexão nem aberta).
+NOTION_RETRY_CODES_CRIACAO = ('rate_limited',)
+NOTION_RETRY_TRANSPORTE_CRIACAO = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+async def notion_call(fn, idempotent=True, **kwargs):
+    endpoint = getattr(fn, '__qualname__', 'notion').replace('Endpoint', '').lower()
+    for attempt in range(NOTION_MAX_TENTATIVAS):
+        try:
+            async with notion_sem:
+                async with timed('bot_notion_segundos', endpoint=endpoint): return await fn(**kwargs)
+        except httpx.TransportError as e:
+            if attempt == NOTION_MAX_TENTATIVAS - 1: raise
+            if not idempotent and not isinstance(e, NOTION_RETRY_TRANSPORTE_CRIACAO): raise
+            metric_count('bot_notion_retentativas_total', endpoint=endpoint)
+            await asyncio.sleep(2 ** attempt)
+        except notion_api_error() as e:
+            if e.code not in (NOTION_RETRY_CODES if idempotent else NOTION_RETRY_CODES_CRIACAO) or attempt == NOTION_MAX_TENTATIVAS - 1: raise
+            metric_count('bot_notion_retentativas_total', endpoint=endpoint)
+            await asyncio.sleep(2 ** attempt)
 
 # --- NOTION & CLIENTES ---
-def refresh_clients_from_notion():
-    global CLIENT_GROUPS
+# Diretório de clientes: sincronização paginada e incremental (last_edited_time), com sync completo periódico
+# para pegar páginas apagadas. Chats desconhecidos vão para um cache negativo com TTL.
+clients_sync_lock = asyncio.Lock()
+clients_sync_task = None
+unknown_chats = {} # chat_id -> expira em (monotonic)
+
+async def query_all_pages(**kwargs):
+    cursor = None
+    while True:
+        if cursor: kwargs['start_cursor'] = cursor
+        res = await notion_call(notion.databases.query, page_size=100, **kwargs)
+        for page in res['results']: yield page
+        if not res.get('has_more') or not res.get('next_cursor'): break
+        cursor = res['next_cursor']
+
+def parse_client_page(page):
     try:
-        response = notion.databases.query(database_id=NOTION_CLIENTS_DB_ID, filter={"property": "Ativo", "checkbox": {"equals": True}})
-        new_map = {}
-        for page in response['results']:
-            try:
-                name = page['properties']['Name']['title'][0]['text']['content']
-                chat_id = int(page['properties']['ChatID']['rich_text'][0]['text']['content'].strip())
-                new_map[chat_id] = name
-            except: pass
-        CLIENT_GROUPS = new_map
-        try: asyncio.create_task(save_state_async())
-        except: pass
-        return f"OK: {len(new_map)} clientes."
-    except Exception as e: return f"Erro: {str(e)}"
+        props = page['properties']
+        name = props['Name']['title'][0]['text']['content']
+        chat_id = int(props['ChatID']['rich_text'][0]['text']['content'].strip())
+        return chat_id, name, bool(props.get('Ativo', {}).get('checkbox'))
+    except: return None
+
+async def refresh_clients_from_notion(full=False):
+    async with clients_sync_lock:
+        try:
+            # last_edited_time do Notion vem arredondado para baixo ao minuto: a marca também, e com folga para
+            # relógio adiantado. Reprocessar as páginas da sobreposição é idempotente.
+            started = (datetime.now(pytz.utc).replace(second=0, microsecond=0) - timedelta(seconds=CLIENTES_SYNC_MARGEM_SEGUNDOS)).isoformat()
+            last_sync = bot_meta.get('clients_synced_at')
+            last_full = bot_meta.get('clients_full_sync_at', 0)
+            if full or not last_sync or time.time() - last_full > CLIENTES_SYNC_COMPLETO_HORAS * 3600:
+                new_map, new_pages = {}, {}
+                async for page in query_all_pages(database_id=NOTION_CLIENTS_DB_ID, filter={"property": "Ativo", "checkbox": {"equals": True}}):
+                    parsed = parse_client_page(page)
+                    if not parsed: continue
+                    new_map[parsed[0]] = parsed[1]
+                    new_pages[page['id']] = parsed[0]
+                CLIENT_GROUPS.replace(new_map)
+                client_pages.replace(new_pages)
+                bot_meta['clients_full_sync_at'] = time.time()
+                changed = len(new_map)
+            else:
+                changed = 0
+                async for page in query_all_pages(database_id=NOTION_CLIENTS_DB_ID, filter={"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": last_sync}}):
+                    old_cid = client_pages.pop(page['id'], None)
+                    if old_cid is not None: CLIENT_GROUPS.pop(old_cid, None)
+                    parsed = parse_client_page(page)
+                    if parsed and parsed[2] and not page.get('archived'):
+                        CLIENT_GROUPS[parsed[0]] = parsed[1]
+                        client_pages[page['id']] = parsed[0]
+                    changed += 1
+            bot_meta['clients_synced_at'] = started
+            for cid in [c for c in unknown_chats if c in CLIENT_GROUPS]: del unknown_chats[cid]
+            await save_state_async()
+            return f"OK: {len(CLIENT_GROUPS)} clientes ({changed} atualizados)."
+        except Exception as e: return f"Erro: {str(e)}"
+
+def refresh_clients_in_background():
+    global clients_sync_task
+    if clients_sync_task is None or clients_sync_task.done():
+        clients_sync_task = asyncio.create_task(refresh_clients_from_notion())
+
+def mark_unknown_chat(chat_id):
+    now = time.monotonic()
+    if len(unknown_chats) > 1000:
+        for c in [c for c, exp in unknown_chats.items() if exp < now]: del unknown_chats[c]
+    unknown_chats[chat_id] = now + CLIENTES_CACHE_NEGATIVO_SEGUNDOS
 
 def get_client_name(chat_id):
-    if chat_id not in CLIENT_GROUPS: refresh_clients_from_notion()
+    # Caminho das mensagens: só memória. Um chat desconhecido dispara no máximo uma sync de fundo por TTL.
+    name = CLIENT_GROUPS.get(chat_id)
+    if name: return name
+    if unknown_chats.get(chat_id, 0) < time.monotonic():
+        mark_unknown_chat(chat_id)
+        refresh_clients_in_background()
+    return str(chat_id)
+
+async def lookup_client(chat_id):
+    # Consulta pontual (1 chamada) de um chat; usada enquanto a sync de boot ainda não terminou
+    f = {"and": [{"property": "ChatID", "rich_text": {"equals": str(chat_id)}}, {"property": "Ativo", "checkbox": {"equals": True}}]}
+    res = await notion_call(notion.databases.query, database_id=NOTION_CLIENTS_DB_ID, filter=f, page_size=1)
+    for page in res['results']:
+        parsed = parse_client_page(page)
+        if parsed:
+            CLIENT_GROUPS[parsed[0]] = parsed[1]
+            client_pages[page['id']] = parsed[0]
+
+async def resolve_client_name(chat_id):
+    # Para o /start: num chat novo vale esperar a sync incremental. Boot a frio (sync completa rodando ou
+    # nunca feita) não espera a base inteira: busca só este chat.
+    if chat_id not in CLIENT_GROUPS and unknown_chats.get(chat_id, 0) < time.monotonic():
+        if clients_sync_lock.locked() or not bot_meta.get('clients_synced_at'):
+            try: await lookup_client(chat_id)
+            except Exception as e: logger.warning(f"Busca do cliente {chat_id} falhou: {e}")
+        else: await refresh_clients_from_notion()
+        if chat_id not in CLIENT_GROUPS: mark_unknown_chat(chat_id)
     return CLIENT_GROUPS.get(chat_id, str(chat_id))
 
 def generate_next_id():
-    return datetime.now(TIMEZONE).strftime("%Y%m%d%H%M%S")
+    # AAAAMMDDHHMMSS + contador de 2 dígitos: único com vários chamados no mesmo segundo, ordenável
+    # e monotônico (o último ID fica em bot_meta, então sobrevive a restart e a relógio que volta).
+    # Com sharding, cada worker usa só os contadores da sua posição (offset, offset + step, ...).
+    step, offset = shard_stride()
+    meta_key = 'last_ticket_id' if step == 1 else f"last_ticket_id:{offset}"
+    now = int(datetime.now(TIMEZONE).strftime("%Y%m%d%H%M%S"))
+    stamp, seq = divmod(int(bot_meta.get(meta_key, 0)), 100)
+    if now > stamp: stamp, seq = now, offset
+    elif seq + step <= 99: seq += step
+    else:
+        # Contadores do segundo esgotados: empresta o próximo segundo
+        stamp = int((datetime.strptime(str(stamp), "%Y%m%d%H%M%S") + timedelta(seconds=1)).strftime("%Y%m%d%H%M%S"))
+        seq = offset
+    tid = f"{stamp}{seq:02d}"
+    bot_meta[meta_key] = tid
+    return tid
 
 def sanitize_notion_text(text):
     if not text: return "Chamado sem Título"
@@ -201,13 +1099,35 @@ def sanitize_notion_text(text):
     clean = clean.replace('\n', ' ').strip()
     return clean[:100]
 
-def create_ticket(user, desc, chat_id):
+# --- ÍNDICE TICKET -> PÁGINA ---
+async def find_ticket_page(ticket_id):
+    pid = ticket_pages.get(ticket_id)
+    if pid: return pid
+    res = await notion_call(notion.databases.query, database_id=NOTION_TICKETS_DB_ID, filter={"property": "Name", "title": {"equals": ticket_id}})
+    if not res['results']: return None
+    ticket_pages[ticket_id] = res['results'][0]['id']
+    return ticket_pages[ticket_id]
+
+async def ticket_page_call(ticket_id, fn, id_arg, **kwargs):
+    # Executa fn no page_id do ticket; se o índice estiver velho (página apagada), refaz a busca uma vez.
+    for attempt in range(2):
+        cached = ticket_id in ticket_pages
+        pid = await find_ticket_page(ticket_id)
+        if not pid: return None
+        try: return await notion_call(fn, **{id_arg: pid}, **kwargs)
+        except notion_api_error() as e:
+            if not cached or e.code != 'object_not_found': raise
+            ticket_pages.pop(ticket_id, None)
+    return None
+
+async def create_ticket(user, desc, chat_id):
     try:
         tid = generate_next_id()
         client = get_client_name(chat_id)
         date_iso = datetime.now(TIMEZONE).isoformat()
         safe_desc = str(desc) if desc else "Sem descrição"
-        notion.pages.create(
+        page = await notion_call(
+            notion.pages.create, idempotent=False,
             parent={"database_id": NOTION_TICKETS_DB_ID},
             properties={
                 "Name": {"title": [{"text": {"content": tid}}]},
@@ -218,86 +1138,532 @@ def create_ticket(user, desc, chat_id):
                 "Date": {"date": {"start": date_iso}}
             }
         )
+        ticket_pages[tid] = page['id']
+        ticket_mirror.submit(ticket_mirror.add_ticket, {'ticket_id': tid, 'page_id': page['id'], 'client': client, 'status': "Em Andamento", 'solicitante': user, 'descricao': safe_desc})
+        invalidate_active_tickets(client=client)
         return tid, None
     except Exception as e: return None, str(e)
 
-def get_ticket_desc(ticket_id):
+async def get_ticket_desc(ticket_id):
+    if ticket_mirror.fresh():
+        desc = ticket_mirror.desc(ticket_id)
+        if desc is not None: return desc
     try:
-        res = notion.databases.query(database_id=NOTION_TICKETS_DB_ID, filter={"property": "Name", "title": {"equals": ticket_id}})
-        if not res['results']: return ""
-        props = res['results'][0]['properties']
+        page = await ticket_page_call(ticket_id, notion.pages.retrieve, 'page_id')
+        if not page: return ""
+        props = page['properties']
         if 'Descricao' in props and props['Descricao']['rich_text']:
             return props['Descricao']['rich_text'][0]['text']['content']
         return ""
     except: return ""
 
-def update_ticket_properties(ticket_id, updates):
+async def update_ticket_properties(ticket_id, updates):
     try:
-        res = notion.databases.query(database_id=NOTION_TICKETS_DB_ID, filter={"property": "Name", "title": {"equals": ticket_id}})
-        if not res['results']: return False
-        page_id = res['results'][0]['id']
-        notion.pages.update(page_id=page_id, properties=updates)
+        if not await ticket_page_call(ticket_id, notion.pages.update, 'page_id', properties=updates): return False
+        if updates.get("Status", {}).get("status", {}).get("name") == "Finalizado": ticket_pages.pop(ticket_id, None)
+        cols = {}
+        if "Status" in updates: cols['status'] = updates["Status"]["status"]["name"]
+        if "Descricao" in updates: cols['descricao'] = get_text(updates["Descricao"]["rich_text"])
+        ticket_mirror.submit(ticket_mirror.update_ticket, ticket_id, **cols)
+        invalidate_active_tickets(ticket_id=ticket_id)
         return True
     except: return False
 
-def get_active_tickets_data(chat_id):
+# Chamados ativos por cliente, com TTL curto; create_ticket e update_ticket_properties invalidam
+active_tickets_cache = {} # nome do cliente -> (carregado_em, [{'id', 'desc'}])
+
+def invalidate_active_tickets(client=None, ticket_id=None):
+    if client is not None: active_tickets_cache.pop(client, None)
+    if ticket_id is not None:
+        for c in [c for c, (_, data) in active_tickets_cache.items() if any(t['id'] == ticket_id for t in data)]:
+            del active_tickets_cache[c]
+
+def short_desc(d):
+    d = d or "..."
+    return d[:25] + "..." if len(d) > 25 else d
+
+async def get_active_tickets_data(chat_id):
     client = get_client_name(chat_id)
+    if ticket_mirror.fresh():
+        rows = ticket_mirror.active(client)
+        if rows is not None:
+            for t_id, pid, _ in rows:
+                if pid: ticket_pages[t_id] = pid
+            return [{"id": t_id, "desc": short_desc(d)} for t_id, _, d in rows]
+    hit = active_tickets_cache.get(client)
+    if hit and time.monotonic() - hit[0] < CHAMADOS_CACHE_SEGUNDOS: return hit[1]
     try:
         f = {"and": [{"property": "Status", "status": {"equals": "Em Andamento"}}, {"property": "ChatID", "rich_text": {"equals": client}}]}
-        response = notion.databases.query(database_id=NOTION_TICKETS_DB_ID, filter=f)
         data = []
-        for p in response['results']:
-            try: t_id = p['properties']['Name']['title'][0]['text']['content']
+        async for p in query_all_pages(database_id=NOTION_TICKETS_DB_ID, filter=f):
+            try:
+                t_id = p['properties']['Name']['title'][0]['text']['content']
+                ticket_pages[t_id] = p['id']
             except: t_id = "?"
             try: d = p['properties']['Descricao']['rich_text'][0]['text']['content']
             except: d = "..."
-            if len(d) > 25: d = d[:25] + "..."
-            data.append({"id": t_id, "desc": d})
+            data.append({"id": t_id, "desc": short_desc(d)})
+        active_tickets_cache[client] = (time.monotonic(), data)
         return data
     except Exception as e: return []
 
-def append_comment_to_ticket(ticket_id, user, text, is_summary=False):
+async def append_comment_to_ticket(ticket_id, user, text, is_summary=False):
     try:
-        res = notion.databases.query(database_id=NOTION_TICKETS_DB_ID, filter={"property": "Name", "title": {"equals": ticket_id}})
-        if not res['results']: return False, "Não encontrado."
-        pid = res['results'][0]['id']
         ts = datetime.now(TIMEZONE).strftime("%d/%m %H:%M")
         children = []
         if is_summary:
             children = [
                 {"object": "block", "type": "heading_3", "heading_3": {"rich_text": [{"type": "text", "text": {"content": f"🤖 Resumo IA ({ts})"}}]}},
-                {"object": "block", "type": "quote", "quote": {"rich_text": [{"type": "text", "text": {"content": text}}]}},
+                {"object": "block", "type": "quote", "quote": {"rich_text": rich_text(text)}},
                 {"object": "block", "type": "divider", "divider": {}}
             ]
         else:
-            children = [{"object": "block", "type": "paragraph", "paragraph": {"rich_text": [{"type": "text", "text": {"content": f"💬 {ts} - {user}:\n{text}"}}]}}]
-        notion.blocks.children.append(block_id=pid, children=children)
+            children = [comment_block(ts, user, text)]
+        if not await ticket_page_call(ticket_id, notion.blocks.children.append, 'block_id', idempotent=False, children=children): return False, "Não encontrado."
+        history_cache_append(ticket_id, children)
         return True, ""
     except Exception as e: return False, str(e)
 
-def get_ticket_history(ticket_id):
+# --- HISTÓRICO DE TICKETS ---
+# Histórico renderizado (lista de entradas) em cache por ticket; append_comment_to_ticket acrescenta direto no cache.
+history_cache = OrderedDict() # ticket_id -> (carregado_em, [entradas])
+
+def get_text(rich_text_list):
+    # Blocos vindos do Notion têm plain_text; os que nós montamos só têm text.content
+    return "".join([t.get('plain_text') or t.get('text', {}).get('content', '') for t in rich_text_list]) if rich_text_list else ""
+
+def render_block(b):
+    b_type = b['type']
+    if b_type == 'divider': return "━━━━━━━━━━━━━━━━"
+    elif b_type == 'paragraph': return get_text(b['paragraph'].get('rich_text', []))
+    elif b_type == 'to_do': return f"{'✅' if b['to_do'].get('checked') else '⬜'} {get_text(b['to_do'].get('rich_text', []))}"
+    elif b_type == 'toggle': return f"▶️ {get_text(b['toggle'].get('rich_text', []))}"
+    elif b_type == 'bulleted_list_item': return f"• {get_text(b['bulleted_list_item'].get('rich_text', []))}"
+    elif b_type == 'numbered_list_item': return f"1. {get_text(b['numbered_list_item'].get('rich_text', []))}"
+    elif b_type == 'quote': return f"{get_text(b['quote'].get('rich_text', []))}"
+    elif b_type == 'heading_3': return f"\n**{get_text(b['heading_3'].get('rich_text', []))}**"
+    return ""
+
+def render_blocks(blocks):
+    hist = []
+    for b in blocks:
+        try:
+            content = render_block(b)
+            if content: hist.append(content)
+        except: continue
+    return hist
+
+def history_cache_append(ticket_id, blocks):
+    # Blocos que acabamos de gravar no Notion: entram no cache e no espelho sem reler
+    entries = render_blocks(blocks)
+    hit = history_cache.get(ticket_id)
+    if hit: hit[1].extend(entries)
+    ticket_mirror.submit(ticket_mirror.add_comments, ticket_id, entries)
+
+async def get_ticket_history(ticket_id):
+    # Retorna (entradas, erro); percorre todas as páginas de blocos
+    if ticket_mirror.fresh():
+        entries = ticket_mirror.history(ticket_id)
+        if entries is not None: return entries, None
+    hit = history_cache.get(ticket_id)
+    if hit and time.monotonic() - hit[0] < HISTORICO_CACHE_MINUTOS * 60:
+        history_cache.move_to_end(ticket_id)
+        return hit[1], None
     try:
-        res = notion.databases.query(database_id=NOTION_TICKETS_DB_ID, filter={"property": "Name", "title": {"equals": ticket_id}})
-        if not res['results']: return "Não encontrado."
-        blocks = notion.blocks.children.list(block_id=res['results'][0]['id'])
-        hist = []
-        def get_text(rich_text_list): return "".join([t['plain_text'] for t in rich_text_list]) if rich_text_list else ""
-        for b in blocks['results']:
-            try:
-                b_type = b['type']
-                content = ""
-                if b_type == 'divider': hist.append("━━━━━━━━━━━━━━━━")
-                elif b_type == 'paragraph': content = get_text(b['paragraph'].get('rich_text', []))
-                elif b_type == 'to_do': content = f"{'✅' if b['to_do'].get('checked') else '⬜'} {get_text(b['to_do'].get('rich_text', []))}"
-                elif b_type == 'toggle': content = f"▶️ {get_text(b['toggle'].get('rich_text', []))}"
-                elif b_type == 'bulleted_list_item': content = f"• {get_text(b['bulleted_list_item'].get('rich_text', []))}"
-                elif b_type == 'numbered_list_item': content = f"1. {get_text(b['numbered_list_item'].get('rich_text', []))}"
-                elif b_type == 'quote': content = f"{get_text(b['quote'].get('rich_text', []))}"
-                elif b_type == 'heading_3': content = f"\n**{get_text(b['heading_3'].get('rich_text', []))}**"
-                if content: hist.append(content)
-            except: continue
-        return "\n\n".join(hist) if hist else "Nenhuma observação."
-    except Exception as e: return f"Erro leitura: {str(e)}"
+        blocks, cursor = [], None
+        while True:
+            kwargs = {'page_size': 100}
+            if cursor: kwargs['start_cursor'] = cursor
+            res = await ticket_page_call(ticket_id, notion.blocks.children.list, 'block_id', **kwargs)
+            if not res: return None, "Não encontrado."
+            blocks.extend(res['results'])
+            if not res.get('has_more') or not res.get('next_cursor'): break
+            cursor = res['next_cursor']
+        entries = render_blocks(blocks)
+        history_cache[ticket_id] = (time.monotonic(), entries)
+        while len(history_cache) > HISTORICO_CACHE_TICKETS: history_cache.popitem(last=False)
+        return entries, None
+    except Exception as e: return None, f"Erro leitura: {str(e)}"
+
+def paginate_history(entries, limit=None):
+    # Quebra em páginas que cabem numa mensagem do Telegram (4096 chars, com folga para cabeçalho)
+    limit = limit or HISTORICO_PAGINA_CHARS
+    pages, cur = [], ""
+    for entry in entries:
+        pieces = [entry[i:i + limit] for i in range(0, len(entry), limit)] or [""]
+        for piece in pieces:
+            if cur and len(cur) + 2 + len(piece) > limit:
+                pages.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{piece}" if cur else piece
+    if cur: pages.append(cur)
+    return pages or ["Nenhuma observação."]
+
+async def show_history_page(q, tid, page):
+    entries, err = await get_ticket_history(tid)
+    pages = paginate_history(entries) if entries is not None else [err]
+    page = max(0, min(page, len(pages) - 1))
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"vwp_{tid}_{page - 1}"))
+    if page < len(pages) - 1: nav.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"vwp_{tid}_{page + 1}"))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton("🔙 Voltar", callback_data='back')])
+    header = f"📊 *Histórico {tid}:*" + (f" ({page + 1}/{len(pages)})" if len(pages) > 1 else "")
+    await q.edit_message_text(f"{header}\n\n{pages[page]}", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+
+# --- ESPELHO DE CHAMADOS ---
+# Cópia local da base de chamados em ESPELHO_DB: propriedades em tickets, histórico já renderizado (as mesmas
+# entradas de render_blocks) em comments e índices FTS5 (external content, mantidos por triggers) para o /buscar.
+# - sync incremental por last_edited_time em ordem crescente; a marca avança página a página, então retoma se cair;
+# - create_ticket, update_ticket_properties e os appends gravam aqui na hora (write-through);
+# - enquanto a última sync tiver menos de ESPELHO_FRESCO_SEGUNDOS, lista de ativos, descrição e histórico saem daqui.
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (id INTEGER PRIMARY KEY, ticket_id TEXT UNIQUE NOT NULL, page_id TEXT, client TEXT, status TEXT,
+    solicitante TEXT, descricao TEXT, editado TEXT, sincronizado REAL);
+CREATE INDEX IF NOT EXISTS tickets_client ON tickets (client, status);
+CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY, ticket_id TEXT NOT NULL, texto TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS comments_ticket ON comments (ticket_id, id);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v);
+CREATE VIRTUAL TABLE IF NOT EXISTS busca_tickets USING fts5 (descricao, content='tickets', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS busca_comments USING fts5 (texto, content='comments', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS tickets_ai AFTER INSERT ON tickets BEGIN
+    INSERT INTO busca_tickets (rowid, descricao) VALUES (new.id, new.descricao); END;
+CREATE TRIGGER IF NOT EXISTS tickets_ad AFTER DELETE ON tickets BEGIN
+    INSERT INTO busca_tickets (busca_tickets, rowid, descricao) VALUES ('delete', old.id, old.descricao); END;
+CREATE TRIGGER IF NOT EXISTS tickets_au AFTER UPDATE OF descricao ON tickets BEGIN
+    INSERT INTO busca_tickets (busca_tickets, rowid, descricao) VALUES ('delete', old.id, old.descricao);
+    INSERT INTO busca_tickets (rowid, descricao) VALUES (new.id, new.descricao); END;
+CREATE TRIGGER IF NOT EXISTS comments_ai AFTER INSERT ON comments BEGIN
+    INSERT INTO busca_comments (rowid, texto) VALUES (new.id, new.texto); END;
+CREATE TRIGGER IF NOT EXISTS comments_ad AFTER DELETE ON comments BEGIN
+    INSERT INTO busca_comments (busca_comments, rowid, texto) VALUES ('delete', old.id, old.texto); END;
+"""
+
+# Ranking primeiro (só bm25, agrupado por chamado); snippet() é caro e roda depois só para os vencedores
+MIRROR_SEARCH = """
+WITH hits AS (
+    SELECT t.ticket_id AS ticket_id, 'busca_tickets' AS src, h.rowid AS rid, h.score AS score
+    FROM (SELECT rowid, bm25(busca_tickets) * 2 AS score FROM busca_tickets WHERE busca_tickets MATCH :q) h JOIN tickets t ON t.id = h.rowid
+    UNION ALL
+    SELECT c.ticket_id, 'busca_comments', h.rowid, h.score
+    FROM (SELECT rowid, bm25(busca_comments) AS score FROM busca_comments WHERE busca_comments MATCH :q) h JOIN comments c ON c.id = h.rowid
+)
+SELECT h.ticket_id, t.client, t.status, h.src, h.rid, MIN(h.score) FROM hits h JOIN tickets t ON t.ticket_id = h.ticket_id
+WHERE :client IS NULL OR t.client = :client GROUP BY h.ticket_id ORDER BY MIN(h.score) LIMIT :limit
+"""
+
+def mirror_guard(fn):
+    # Falha no espelho não derruba o atendimento: escrita perdida a próxima sync corrige, leitura devolve None e vai ao Notion
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        try: return fn(self, *args, **kwargs)
+        except sqlite3.Error as e:
+            logger.warning(f"Espelho: {fn.__name__} falhou: {e}")
+            return None
+    return wrapper
+
+def iso_to_epoch(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+class TicketMirror:
+    # Três conexões (WAL: leitores não esperam o escritor):
+    #  - escrita: só na thread self.io, em ordem de chegada (submit/run); o event loop nunca espera uma transação
+    #  - leitura do event loop (consultas pontuais: descrição, ativos, histórico)
+    #  - leitura da busca, usada pelas threads do asyncio.to_thread
+    def __init__(self, path):
+        self.path = path
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='espelho')
+        self.read_lock = threading.Lock()
+        self.db = None
+        self.loop_reader = None
+        self.reader = None
+        self.synced_at = 0
+
+    def conn(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL") # espelho é reconstruível: não precisa de fsync por commit
+            self.db.executescript(MIRROR_SCHEMA)
+            row = self.db.execute("SELECT v FROM meta WHERE k = 'synced_at'").fetchone()
+            self.synced_at = row[0] if row else 0
+        return self.db
+
+    def open_reader(self):
+        # O banco e o schema são criados pela thread de escrita antes do primeiro leitor (modo ro não cria nada)
+        if self.db is None: self.io.submit(self.conn).result()
+        return sqlite3.connect(f"{pathlib.Path(self.path).absolute().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+    def read(self):
+        if self.loop_reader is None: self.loop_reader = self.open_reader()
+        return self.loop_reader
+
+    def read_conn(self):
+        if self.reader is None: self.reader = self.open_reader()
+        return self.reader
+
+    def submit(self, fn, *args, **kwargs):
+        return self.io.submit(fn, *args, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        return asyncio.wrap_future(self.io.submit(fn, *args, **kwargs))
+
+    def close(self):
+        self.io.shutdown(wait=True)
+        with self.read_lock:
+            for db in (self.db, self.loop_reader, self.reader):
+                if db is not None: db.close()
+            self.db = self.loop_reader = self.reader = None
+
+    def get_meta(self, k):
+        row = self.read().execute("SELECT v FROM meta WHERE k = ?", (k,)).fetchone()
+        return row[0] if row else None
+
+    @mirror_guard
+    def set_meta(self, k, v):
+        with self.conn() as db: db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (k, v))
+        if k == 'synced_at': self.synced_at = v
+
+    def fresh(self):
+        # Só o valor em memória: sem tocar no banco (nem abrir conexão) no caminho do event loop
+        return time.time() - self.synced_at < ESPELHO_FRESCO_SEGUNDOS
+
+    @mirror_guard
+    def needs_refresh(self, t):
+        # last_edited_time do Notion vem arredondado ao minuto: uma edição no mesmo minuto da última leitura
+        # não muda o valor, então só confia na linha se ela foi lida depois que aquele minuto terminou.
+        row = self.read().execute("SELECT editado, sincronizado FROM tickets WHERE ticket_id = ?", (t['ticket_id'],)).fetchone()
+        return row is None or row[0] != t['editado'] or (row[1] or 0) < iso_to_epoch(t['editado']) + 60
+
+    @mirror_guard
+    def store(self, t, entries, synced_at):
+        # Página relida do Notion: propriedades e histórico completo numa transação
+        with self.conn() as db:
+            db.execute("""INSERT INTO tickets (ticket_id, page_id, client, status, solicitante, descricao, editado, sincronizado)
+                          VALUES (:ticket_id, :page_id, :client, :status, :solicitante, :descricao, :editado, :sincronizado)
+                          ON CONFLICT (ticket_id) DO UPDATE SET page_id = excluded.page_id, client = excluded.client, status = excluded.status,
+                          solicitante = excluded.solicitante, descricao = excluded.descricao, editado = excluded.editado, sincronizado = excluded.sincronizado""",
+                       {**t, 'sincronizado': synced_at})
+            db.execute("DELETE FROM comments WHERE ticket_id = ?", (t['ticket_id'],))
+            db.executemany("INSERT INTO comments (ticket_id, texto) VALUES (?, ?)", [(t['ticket_id'], e) for e in entries])
+
+    @mirror_guard
+    def add_ticket(self, t):
+        # Chamado recém-criado pelo bot; editado vazio faz a próxima sync confirmar com o Notion
+        with self.conn() as db:
+            db.execute("INSERT OR IGNORE INTO tickets (ticket_id, page_id, client, status, solicitante, descricao, editado, sincronizado) VALUES (?, ?, ?, ?, ?, ?, '', 0)",
+                       (t['ticket_id'], t['page_id'], t['client'], t['status'], t['solicitante'], t['descricao']))
+
+    @mirror_guard
+    def update_ticket(self, ticket_id, **cols):
+        if not cols: return
+        with self.conn() as db:
+            db.execute(f"UPDATE tickets SET {', '.join(f'{c} = :{c}' for c in cols)} WHERE ticket_id = :ticket_id", {**cols, 'ticket_id': ticket_id})
+
+    @mirror_guard
+    def add_comments(self, ticket_id, entries):
+        if not entries: return
+        with self.conn() as db:
+            db.executemany("INSERT INTO comments (ticket_id, texto) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM tickets WHERE ticket_id = ?)",
+                           [(ticket_id, e, ticket_id) for e in entries])
+
+    @mirror_guard
+    def prune(self, keep):
+        # Passada completa: some o que não veio do Notion (apagado ou arquivado)
+        ids = [r[0] for r in self.conn().execute("SELECT ticket_id FROM tickets") if r[0] not in keep]
+        with self.conn() as db:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ','.join('?' * len(chunk))
+                db.execute(f"DELETE FROM comments WHERE ticket_id IN ({marks})", chunk)
+                db.execute(f"DELETE FROM tickets WHERE ticket_id IN ({marks})", chunk)
+        return len(ids)
+
+    @mirror_guard
+    def active(self, client):
+        return self.read().execute("SELECT ticket_id, page_id, descricao FROM tickets WHERE client = ? AND status = 'Em Andamento' ORDER BY id", (client,)).fetchall()
+
+    @mirror_guard
+    def desc(self, ticket_id):
+        row = self.read().execute("SELECT descricao FROM tickets WHERE ticket_id = ?", (ticket_id,)).fetchone()
+        return row[0] if row else None
+
+    @mirror_guard
+    def history(self, ticket_id):
+        # None = chamado fora do espelho (o chamador vai ao Notion); [] = chamado sem observações
+        db = self.read()
+        if not db.execute("SELECT 1 FROM tickets WHERE ticket_id = ?", (ticket_id,)).fetchone(): return None
+        return [r[0] for r in db.execute("SELECT texto FROM comments WHERE ticket_id = ? ORDER BY id", (ticket_id,))]
+
+    def search(self, query, client=None, limit=BUSCA_RESULTADOS):
+        # Roda numa thread (asyncio.to_thread) com a conexão de leitura: não segura o lock da escrita.
+        # Cada palavra vira um termo entre aspas: o usuário não precisa (nem consegue) usar a sintaxe do FTS5.
+        # Só a última palavra, com 3+ letras, vale como prefixo (prefixo curto expande para metade do índice).
+        terms = re.findall(r'\w+', query.lower())[:10]
+        if not terms: return []
+        match = " ".join(f'"{t}"' for t in terms[:-1]) + f' "{terms[-1]}"' + ('*' if len(terms[-1]) >= 3 else '')
+        try:
+            with self.read_lock:
+                db = self.read_conn()
+                rows = db.execute(MIRROR_SEARCH, {'q': match, 'client': client, 'limit': limit}).fetchall()
+                out = []
+                for tid, cli, status, src, rid, _ in rows:
+                    trecho = db.execute(f"SELECT snippet({src}, 0, '[', ']', '…', 12) FROM {src} WHERE {src} MATCH ? AND rowid = ?", (match, rid)).fetchone()
+                    out.append((tid, cli, status, trecho[0] if trecho else ""))
+            return out
+        except sqlite3.Error as e:
+            logger.warning(f"Espelho: search falhou: {e}")
+            return None
+
+    @mirror_guard
+    def counts(self):
+        db = self.read()
+        return db.execute("SELECT COUNT(*) FROM tickets").fetchone()[0], db.execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+
+ticket_mirror = TicketMirror(ESPELHO_DB)
+mirror_sync_lock = asyncio.Lock()
+mirror_task = None
+
+def parse_ticket_page(page):
+    try:
+        props = page['properties']
+        return {
+            'ticket_id': get_text(props['Name']['title']),
+            'page_id': page['id'],
+            'client': get_text(props.get('ChatID', {}).get('rich_text', [])),
+            'status': (props.get('Status', {}).get('status') or {}).get('name', ''),
+            'solicitante': get_text(props.get('Solicitante', {}).get('rich_text', [])),
+            'descricao': get_text(props.get('Descricao', {}).get('rich_text', [])),
+            'editado': page['last_edited_time'],
+        }
+    except (KeyError, TypeError): return None
+
+async def list_page_blocks(page_id):
+    blocks, cursor = [], None
+    while True:
+        kwargs = {'page_size': 100}
+        if cursor: kwargs['start_cursor'] = cursor
+        res = await notion_call(notion.blocks.children.list, block_id=page_id, **kwargs)
+        blocks.extend(res['results'])
+        if not res.get('has_more') or not res.get('next_cursor'): break
+        cursor = res['next_cursor']
+    return blocks
+
+async def sync_ticket_mirror(full=False):
+    async with mirror_sync_lock:
+        try:
+            started = time.time()
+            mark = ticket_mirror.get_meta('mark')
+            full = full or not mark or started - (ticket_mirror.get_meta('full_at') or 0) > ESPELHO_SYNC_COMPLETO_HORAS * 3600
+            kwargs = {'sorts': [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+            if not full: kwargs['filter'] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": mark}}
+            seen, changed = set(), 0
+            async with timed('bot_espelho_sync_segundos', tipo='completa' if full else 'incremental'):
+                async for page in query_all_pages(database_id=NOTION_TICKETS_DB_ID, **kwargs):
+                    t = parse_ticket_page(page)
+                    if not t or not t['ticket_id']: continue
+                    seen.add(t['ticket_id'])
+                    if ticket_mirror.needs_refresh(t) is not False:
+                        read_at = time.time()
+                        await ticket_mirror.run(ticket_mirror.store, t, render_blocks(await list_page_blocks(page['id'])), read_at)
+                        changed += 1
+                    ticket_mirror.submit(ticket_mirror.set_meta, 'mark', t['editado'])
+                removed = (await ticket_mirror.run(ticket_mirror.prune, seen) or 0) if full else 0
+            if full: await ticket_mirror.run(ticket_mirror.set_meta, 'full_at', started)
+            await ticket_mirror.run(ticket_mirror.set_meta, 'synced_at', started)
+            metric_count('bot_espelho_paginas_total', changed, tipo='completa' if full else 'incremental')
+            return f"OK: {changed} chamados atualizados, {removed} removidos ({'completa' if full else 'incremental'})."
+        except Exception as e:
+            logger.error(f"Erro sync espelho: {e}")
+            return f"Erro: {str(e)}"
+
+async def mirror_loop():
+    while True:
+        await sync_ticket_mirror()
+        await asyncio.sleep(ESPELHO_SYNC_SEGUNDOS)
+
+def start_mirror_sync():
+    global mirror_task
+    mirror_task = asyncio.create_task(mirror_loop())
+
+def mirror_stats_text():
+    counts = ticket_mirror.counts()
+    if counts is None: return "indisponível"
+    age = f"há {time.time() - ticket_mirror.synced_at:.0f}s" if ticket_mirror.synced_at else "nunca"
+    return f"{counts[0]} chamados | {counts[1]} entradas | sync {age}{'' if ticket_mirror.fresh() else ' (lendo do Notion)'}"
+
+# --- BUFFER DE MENSAGENS (WRITE-BEHIND) ---
+# Mensagens do atendimento vão para notion_outbox (persistido no journal) e sobem ao Notion num único
+# blocks.children.append quando o buffer enche (OUTBOX_MAX_MSGS) ou envelhece (OUTBOX_SEGUNDOS).
+outbox_locks = {}
+outbox_task = None
+
+def rich_text(content):
+    # Notion aceita no máximo 2000 chars por objeto de texto
+    content = content or ""
+    return [{"type": "text", "text": {"content": content[i:i + 2000]}} for i in range(0, max(len(content), 1), 2000)]
+
+def comment_block(ts, user, text):
+    return {"object": "block", "type": "paragraph", "paragraph": {"rich_text": rich_text(f"💬 {ts} - {user}:\n{text}")}}
+
+async def queue_ticket_comment(ticket_id, user, text):
+    buf = notion_outbox.get(ticket_id)
+    if not buf: buf = notion_outbox[ticket_id] = {'first_at': time.time(), 'items': []}
+    buf['items'].append((datetime.now(TIMEZONE).strftime("%d/%m %H:%M"), user, text))
+    notion_outbox.touch(ticket_id)
+    await save_state_async()
+    if len(buf['items']) >= OUTBOX_MAX_MSGS: asyncio.create_task(flush_ticket_outbox(ticket_id))
+
+async def flush_ticket_outbox(ticket_id):
+    # Um flush por ticket de cada vez; a entrada do lock some quando ninguém mais espera por ela
+    entry = outbox_locks.get(ticket_id)
+    if entry is None: entry = outbox_locks[ticket_id] = {'lock': asyncio.Lock(), 'depth': 0}
+    entry['depth'] += 1
+    try:
+        async with entry['lock']: return await send_ticket_outbox(ticket_id)
+    finally:
+        entry['depth'] -= 1
+        if entry['depth'] == 0: del outbox_locks[ticket_id]
+
+async def send_ticket_outbox(ticket_id):
+    buf = notion_outbox.get(ticket_id)
+    if not buf or not buf['items']: return True
+    items = list(buf['items'])
+    children = [comment_block(*item) for item in items]
+    try:
+        # Limite do Notion: 100 blocos por append. Cada lote enviado sai do buffer na hora:
+        # se um lote seguinte falhar, o próximo flush não reenvia (e duplica) os anteriores
+        for i in range(0, len(children), 100):
+            chunk = children[i:i + 100]
+            if not await ticket_page_call(ticket_id, notion.blocks.children.append, 'block_id', idempotent=False, children=chunk):
+                logger.warning(f"Outbox: ticket {ticket_id} não encontrado, descartando {len(items) - i} msgs")
+                del buf['items'][:len(items) - i]
+                break
+            history_cache_append(ticket_id, chunk)
+            del buf['items'][:len(chunk)]
+            notion_outbox.touch(ticket_id)
+    except Exception as e:
+        logger.error(f"Erro outbox {ticket_id}: {e}")
+        await save_state_async()
+        return False
+    # O que chegou durante o envio fica para o próximo lote
+    if buf['items']:
+        buf['first_at'] = time.time()
+        notion_outbox.touch(ticket_id)
+    else: del notion_outbox[ticket_id]
+    await save_state_async()
+    return True
+
+async def outbox_loop():
+    while True:
+        await asyncio.sleep(OUTBOX_VERIFICACAO_SEGUNDOS)
+        now = time.time()
+        for tid in [t for t, buf in notion_outbox.items() if now - buf['first_at'] >= OUTBOX_SEGUNDOS]:
+            await flush_ticket_outbox(tid)
+
+def start_outbox_flusher():
+    global outbox_task
+    outbox_task = asyncio.create_task(outbox_loop())
 
 # --- HELPER ---
 def is_business_hours():
@@ -306,67 +1672,435 @@ def is_business_hours():
     if HORA_INICIO_EXPEDIENTE <= n.hour < HORA_FIM_EXPEDIENTE: return True
     return False
 
-async def open_group_globally(chat_id, context):
+# --- CONCORRÊNCIA POR CHAT ---
+# Updates do mesmo chat rodam em ordem (um lock por chat); chats diferentes rodam em paralelo.
+# Jobs de fundo que mexem no estado de um chat (inatividade, fechamento agendado, áudio) usam o mesmo lock.
+chat_locks = {} # chat_id -> {'lock', 'depth'} (depth = em execução + esperando)
+chat_queue_peak = {}
+
+@asynccontextmanager
+async def chat_lock(chat_id):
+    entry = chat_locks.get(chat_id)
+    if entry is None: entry = chat_locks[chat_id] = {'lock': asyncio.Lock(), 'depth': 0}
+    entry['depth'] += 1
+    if entry['depth'] > chat_queue_peak.get(chat_id, 0): chat_queue_peak[chat_id] = entry['depth']
+    try:
+        async with entry['lock']: yield
+    finally:
+        entry['depth'] -= 1
+        if entry['depth'] == 0: del chat_locks[chat_id]
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    # O semáforo do PTB (max_concurrent_updates) só admite o update; o limite de handlers rodando é o
+    # self.running, pego depois do lock do chat, para um chat com fila longa não segurar vagas dos outros
+    def __init__(self, max_concurrent_updates, max_running):
+        super().__init__(max_concurrent_updates)
+        self.running = asyncio.BoundedSemaphore(max_running)
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.running: return await coroutine
+        async with chat_lock(chat.id):
+            async with self.running: await coroutine
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+def chat_queue_text(top=5):
+    depths = sorted(((e['depth'], c) for c, e in chat_locks.items()), reverse=True)[:top]
+    peaks = sorted(((p, c) for c, p in chat_queue_peak.items()), reverse=True)[:top]
+    now = ", ".join(f"{c}: {d}" for d, c in depths) or "nenhuma"
+    peak = ", ".join(f"{c}: {p}" for p, c in peaks) or "-"
+    return f"Filas agora: {now}\nPicos: {peak}"
+
+# --- WEBHOOK ---
+# Servidor HTTP embutido (aiohttp, só importado nesse modo). O handler HTTP só valida e enfileira;
+# os workers passam cada update pelo ChatUpdateProcessor (ordem por chat + limite global) até os handlers.
+webhook_queue = None
+webhook_workers = []
+webhook_stats = {'recebidos': 0, 'recusados': 0, 'processados': 0, 'erros': 0}
+
+async def webhook_worker(app):
+    while True:
+        update = await webhook_queue.get()
+        try: await app.update_processor.process_update(update, app.process_update(update))
+        except Exception as e:
+            webhook_stats['erros'] += 1
+            logger.error(f"Erro no update {update.update_id}: {e}")
+        finally:
+            webhook_stats['processados'] += 1
+            webhook_queue.task_done()
+
+def make_webhook_app(app):
+    from aiohttp import web
+    async def receive(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return web.Response(status=403)
+        # Worker que ainda não recebeu o anel não tem o estado de nenhum chat: o Telegram reenvia depois
+        if shard_ring is not None and not shard_ring.nodes: return web.Response(status=503)
+        try: update = Update.de_json(await request.json(), app.bot)
+        except Exception: return web.Response(status=400)
+        try: webhook_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            webhook_stats['recusados'] += 1
+            return web.Response(status=503)
+        webhook_stats['recebidos'] += 1
+        return web.Response()
+    async def membership(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return web.Response(status=403)
+        body = await request.json()
+        if body.get('fase') == 'liberar': moved = await shard_release(body['workers'])
+        else: moved = await shard_acquire()
+        return web.json_response({'chats': moved})
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive)
+    if SHARD_MODO == 'worker':
+        web_app.router.add_get('/shard/saude', lambda request: web.Response(text=SHARD_BOOT_ID) if request.headers.get('X-Telegram-Bot-Api-Secret-Token') == WEBHOOK_SECRET else web.Response(status=403))
+        web_app.router.add_post('/shard/membros', membership)
+    return web_app
+
+async def start_webhook_server(app):
+    from aiohttp import web
+    global webhook_queue
+    webhook_queue = asyncio.Queue(maxsize=WEBHOOK_FILA_MAX)
+    webhook_workers.extend(asyncio.create_task(webhook_worker(app)) for _ in range(WEBHOOK_WORKERS))
+    runner = web.AppRunner(make_webhook_app(app), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    return runner
+
+async def stop_webhook_server(runner, timeout=10):
+    await runner.cleanup()
+    try: await asyncio.wait_for(webhook_queue.join(), timeout)
+    except asyncio.TimeoutError: logger.warning(f"Webhook: {webhook_queue.qsize()} updates descartados no desligamento")
+    for w in webhook_workers: w.cancel()
+    webhook_workers.clear()
+
+def webhook_stats_text():
+    if webhook_queue is None: return "polling"
+    st = webhook_stats
+    return f"Fila: {webhook_queue.qsize()}/{WEBHOOK_FILA_MAX} | recebidos {st['recebidos']} | processados {st['processados']} | 503 {st['recusados']} | erros {st['erros']}"
+
+def require_webhook_setup():
+    # Sem segredo qualquer um que alcance a porta injeta updates (ou mexe nos shards): não sobe
+    if not WEBHOOK_SECRET: raise SystemExit(f"WEBHOOK_SECRET é obrigatório no modo {SHARD_MODO or BOT_MODO}")
+    # Snapshot + journal é de um processo só: chats rebalanceados chegariam sem estado e os arquivos se sobrescreveriam
+    if SHARD_MODO == 'worker' and STATE_BACKEND != 'sqlite': raise SystemExit("SHARD_MODO=worker exige STATE_BACKEND=sqlite")
+
+async def run_webhook(app):
+    # Mesmo ciclo de vida do run_polling (post_init/post_shutdown), trocando o polling pelo servidor HTTP
+    import signal
+    require_webhook_setup()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await app.initialize()
+    if app.post_init: await app.post_init(app)
+    await app.start()
+    runner = await start_webhook_server(app)
+    try:
+        # Com sharding, quem registra o webhook é o router
+        if WEBHOOK_URL and SHARD_MODO != 'worker': await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_CONEXOES)
+        await stop.wait()
+    finally:
+        await stop_webhook_server(runner)
+        await app.stop()
+        if app.post_stop: await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown: await app.post_shutdown(app)
+
+# --- SHARDING ---
+# Cada chat pertence a um worker, escolhido por hash consistente (anel com SHARD_VNODES pontos por worker).
+# O router recebe o webhook do Telegram e repassa cada update ao worker dono. Quando um worker entra ou sai
+# (health check), o router pausa o repasse e rebalanceia em duas fases: 'liberar' (quem perde chats grava e solta
+# o estado deles) e 'assumir' (quem ganha carrega do backend). Para o estado acompanhar o chat, os workers
+# compartilham STATE_BACKEND=sqlite e o LOG_DIR (worker com o backend de arquivo não sobe: ver require_webhook_setup).
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((ring_hash(f"{n}#{i}"), n) for n in self.nodes for i in range(vnodes))
+        self.keys = [h for h, _ in points]
+        self.owners = [n for _, n in points]
+    def owner(self, key):
+        if not self.keys: return None
+        return self.owners[bisect.bisect(self.keys, ring_hash(key)) % len(self.keys)]
+
+# Worker começa sem chats: só assume o que o router mandar. O boot id no /shard/saude mostra ao router que
+# o worker reiniciou (mesmo entre dois health checks) e precisa receber o anel de novo
+shard_ring = HashRing([]) if SHARD_MODO == 'worker' else None
+SHARD_BOOT_ID = os.urandom(8).hex()
+shard_prev_ring = None
+
+def owns_chat(chat_id):
+    return shard_ring is None or shard_ring.owner(chat_id) == SHARD_ID
+
+def shard_stride():
+    # (passo, offset) do contador de IDs: posição fixa deste worker em SHARD_WORKERS
+    if SHARD_MODO != 'worker' or SHARD_ID not in SHARD_WORKERS: return 1, 0
+    return len(SHARD_WORKERS), SHARD_WORKERS.index(SHARD_ID)
+
+def drop_foreign_chats():
+    # Solta da memória o estado por chat que é de outro worker, sem gravar remoção no backend
+    dropped = set()
+    for name, chat_of in CHAT_STATE.items():
+        d = STATE_DICTS[name]
+        for k in [k for k in d if not owns_chat(chat_of(k))]:
+            dict.pop(d, k)
+            state_dirty.pop((name, k), None)
+            dropped.add(chat_of(k))
+    return dropped
+
+async def shard_release(workers):
+    global shard_ring, shard_prev_ring
+    shard_prev_ring, shard_ring = shard_ring, HashRing(workers)
+    # O router já parou de mandar updates: termina os que estão na fila e os que estão rodando
+    if webhook_queue is not None: await webhook_queue.join()
+    chats = {chat_of(k) for name, chat_of in CHAT_STATE.items() for k in STATE_DICTS[name]} | set(session_log_counts)
+    lost = [c for c in chats if not owns_chat(c)]
+    for c in lost:
+        async with chat_lock(c): pass
+    await flush_state()
+    drop_foreign_chats()
+    # Logs dos chats que saem precisam estar em disco antes do novo dono reler
+    await flush_session_logs()
+    for c in lost:
+        disarm_inactivity(c)
+        session_log_counts.pop(c, None)
+    for k in [k for k in prompt_messages if int(k.split('_')[1]) in lost]: del prompt_messages[k]
+    logger.info(f"Shard: {len(lost)} chats liberados")
+    return len(lost)
+
+async def shard_acquire():
+    data, _ = await asyncio.to_thread(state_backend.load)
+    prev = shard_prev_ring
+    gained = set()
+    for name, chat_of in CHAT_STATE.items():
+        for k, v in data.get(name, {}).items():
+            c = chat_of(k)
+            if owns_chat(c) and (prev is None or prev.owner(c) != SHARD_ID):
+                dict.__setitem__(STATE_DICTS[name], k, v)
+                gained.add(c)
+    # Dicts compartilhados (índices, sessão do ticket): completa o que outro worker gravou
+    for name, d in STATE_DICTS.items():
+        if name in CHAT_STATE or name in WORKER_STATE: continue
+        for k, v in data.get(name, {}).items():
+            if k not in d: dict.__setitem__(d, k, v)
+    for c in gained:
+        load_session_log(c)
+        if group_status.get(c) == 'OPEN' and last_activity.get(c): arm_inactivity(c)
+    logger.info(f"Shard: {len(gained)} chats assumidos")
+    return len(gained)
+
+# Router
+router_ring = HashRing([])
+router_live = {} # worker -> boot id visto no último rebalanceamento
+router_gate = asyncio.Event() # aberto = repassando; fechado = rebalanceando (Telegram recebe 503 e reenvia)
+router_inflight = [0]
+router_session = None
+router_stats = {'repassados': 0, 'recusados': 0, 'rebalanceamentos': 0}
+
+def update_chat_id(data):
+    # Chat do update cru, sem montar o objeto Update (o router não processa nada)
+    for v in data.values():
+        if not isinstance(v, dict): continue
+        chat = v.get('chat') or (v.get('message') or {}).get('chat')
+        if chat: return chat['id']
+        if v.get('from'): return v['from']['id']
+    return 0
+
+def make_router_app():
+    from aiohttp import web
+    async def receive(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return web.Response(status=403)
+        body = await request.read()
+        try: chat_id = update_chat_id(json.loads(body))
+        except Exception: return web.Response(status=400)
+        owner = router_ring.owner(chat_id)
+        if not router_gate.is_set() or owner is None:
+            router_stats['recusados'] += 1
+            return web.Response(status=503)
+        router_inflight[0] += 1
+        try:
+            async with router_session.post(owner + WEBHOOK_PATH, data=body, headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}) as r: status = r.status
+        except Exception: status = 503 # worker fora: o health check tira ele do anel
+        finally: router_inflight[0] -= 1
+        router_stats['repassados' if status == 200 else 'recusados'] += 1
+        return web.Response(status=200 if status == 200 else 503)
+    async def state(request):
+        return web.json_response({'workers': sorted(router_live), **router_stats})
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive)
+    web_app.router.add_get('/shard/estado', state)
+    return web_app
+
+async def shard_request(worker, path, payload):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+    async with router_session.post(worker + path, json=payload, headers=headers) as r: return r.status == 200
+
+async def router_rebalance(live):
+    global router_ring
+    router_gate.clear()
+    while router_inflight[0]: await asyncio.sleep(0.05)
+    workers = sorted(live)
+    failed = set()
+    for fase in ('liberar', 'assumir'):
+        results = await asyncio.gather(*(shard_request(w, '/shard/membros', {'fase': fase, 'workers': workers}) for w in workers), return_exceptions=True)
+        for w, ok in zip(workers, results):
+            if ok is not True:
+                logger.error(f"Shard: {w} falhou em '{fase}': {ok}")
+                failed.add(w)
+    router_ring = HashRing(workers)
+    router_live.clear()
+    # Sem boot id registrado, quem falhou é rebalanceado de novo no próximo health check
+    router_live.update({w: (None if w in failed else b) for w, b in live.items()})
+    router_stats['rebalanceamentos'] += 1
+    logger.info(f"Shard: anel com {len(workers)} workers: {workers}")
+    if workers: router_gate.set()
+
+async def router_health_check():
+    # Rebalanceia quando um worker entra, sai ou reinicia (boot id diferente): reiniciado volta sem anel
+    async def boot_id(w):
+        try:
+            async with router_session.get(w + '/shard/saude', headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}) as r:
+                return await r.text() if r.status == 200 else None
+        except Exception: return None
+    results = await asyncio.gather(*(boot_id(w) for w in SHARD_WORKERS))
+    live = {w: b for w, b in zip(SHARD_WORKERS, results) if b}
+    if live != router_live: await router_rebalance(live)
+
+async def router_health_loop():
+    while True:
+        try: await router_health_check()
+        except Exception as e: logger.error(f"Shard: erro no health check: {e}")
+        await asyncio.sleep(SHARD_SAUDE_SEGUNDOS)
+
+async def start_router_server():
+    from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+    global router_session
+    router_session = ClientSession(timeout=ClientTimeout(total=SHARD_TIMEOUT), connector=TCPConnector(limit=WEBHOOK_WORKERS * max(len(SHARD_WORKERS), 1)))
+    runner = web.AppRunner(make_router_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    return runner
+
+async def run_router():
+    import signal
+    from telegram import Bot
+    require_webhook_setup()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    runner = await start_router_server()
+    health = asyncio.create_task(router_health_loop())
+    try:
+        if WEBHOOK_URL:
+            async with Bot(TELEGRAM_TOKEN) as tg: await tg.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_CONEXOES)
+        await stop.wait()
+    finally:
+        health.cancel()
+        await runner.cleanup()
+        await router_session.close()
+
+# --- INATIVIDADE ---
+# Heap de prazos (deadline, chat_id). Rearmar só empilha um novo prazo; entradas velhas são descartadas
+# quando chegam ao topo (inactivity_deadlines guarda o prazo válido de cada chat).
+inactivity_heap = []
+inactivity_deadlines = {}
+inactivity_wakeup = asyncio.Event()
+inactivity_task = None
+
+def touch_activity(chat_id):
+    last_activity[chat_id] = datetime.now(TIMEZONE)
+    if group_status.get(chat_id) == 'OPEN': arm_inactivity(chat_id)
+
+def arm_inactivity(chat_id, deadline=None):
+    deadline = deadline or last_activity[chat_id].timestamp() + MINUTOS_INATIVIDADE * 60
+    inactivity_deadlines[chat_id] = deadline
+    if len(inactivity_heap) > 4 * len(inactivity_deadlines) + 100:
+        inactivity_heap[:] = [(d, c) for c, d in inactivity_deadlines.items()]
+        heapq.heapify(inactivity_heap)
+    else: heapq.heappush(inactivity_heap, (deadline, chat_id))
+    if inactivity_heap[0] == (deadline, chat_id): inactivity_wakeup.set()
+
+def disarm_inactivity(chat_id):
+    inactivity_deadlines.pop(chat_id, None)
+
+async def close_inactive(chat_id, app):
+    async with chat_lock(chat_id):
+        # Uma mensagem que chegou enquanto esperava o lock já rearmou o prazo
+        if group_status.get(chat_id) != 'OPEN' or chat_id in inactivity_deadlines: return
+        try: 
+            # Fechamento por Inatividade (PROIBIDO fechar ticket)
+            ok, err = await lock_group_globally(chat_id, app, reason="inactivity")
+            if ok: await show_menu_new_msg(chat_id, app, "🔒 *Fechado por Inatividade*")
+        except Exception as e: ok, err = False, str(e)
+        if not ok:
+            # Grupo continua aberto: sem um novo prazo ninguém tentaria fechar de novo
+            logger.error(f"Erro inact {chat_id}: {err}")
+            if group_status.get(chat_id) == 'OPEN': arm_inactivity(chat_id, time.time() + INATIVIDADE_RETENTATIVA_SEGUNDOS)
+
+async def inactivity_loop(app):
+    # Restart: prazos voltam a partir do last_activity persistido (os vencidos fecham na hora)
+    for c, st in list(group_status.items()):
+        if st == 'OPEN' and last_activity.get(c): arm_inactivity(c)
+    while True:
+        now = time.time()
+        while inactivity_heap:
+            deadline, c = inactivity_heap[0]
+            if inactivity_deadlines.get(c) != deadline:
+                heapq.heappop(inactivity_heap)
+                continue
+            if deadline > now: break
+            heapq.heappop(inactivity_heap)
+            del inactivity_deadlines[c]
+            asyncio.create_task(close_inactive(c, app))
+        timeout = inactivity_heap[0][0] - now if inactivity_heap else None
+        inactivity_wakeup.clear()
+        try: await asyncio.wait_for(inactivity_wakeup.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+def start_inactivity_scheduler(app):
+    global inactivity_task
+    inactivity_task = asyncio.create_task(inactivity_loop(app))
+
+async def open_group_globally(chat_id, context, user_id=0):
     try:
         p = ChatPermissions(can_send_messages=True, can_send_audios=True, can_send_documents=True, can_send_photos=True, can_send_videos=True, can_send_voice_notes=True, can_send_other_messages=True)
         await context.bot.set_chat_permissions(chat_id, p)
+        if group_status.get(chat_id) != 'OPEN': event_log.record(EV_ABERTURA, chat_id, user_id)
         group_status[chat_id] = 'OPEN'
-        last_activity[chat_id] = datetime.now(TIMEZONE)
-        session_logs[chat_id] = [] 
+        touch_activity(chat_id)
+        log_reset(chat_id)
         await save_state_async()
         return True, ""
     except Exception as e: return False, str(e)
 
-# ADICIONADO PARAMETRO 'reason' PARA CONTROLE DA IA
-async def lock_group_globally(chat_id, context, reason="manual"):
+# ADICIONADO PARAMETRO 'reason' PARA CONTROLE DA IA; 'cause' é só para o analítico (default: derivado de reason)
+async def lock_group_globally(chat_id, context, reason="manual", cause=None):
     try:
         await context.bot.set_chat_permissions(chat_id, ChatPermissions(can_send_messages=False))
+        if group_status.get(chat_id) == 'OPEN':
+            cause = cause or ('inatividade' if reason == "inactivity" else 'manual')
+            event_log.record(EV_FECHAMENTO, chat_id, code=CAUSAS_FECHAMENTO.index(cause))
         group_status[chat_id] = 'CLOSED'
+        disarm_inactivity(chat_id)
         
-        logs = session_logs.get(chat_id, [])
         ticket_id = active_ticket_session.get(chat_id)
         is_first = ticket_first_session.get(ticket_id, False)
         
         final_msg = "🔒 *Atendimento Encerrado.*" 
         
-        if logs and ticket_id:
-            current_desc = get_ticket_desc(ticket_id)
-            # PASSA O MOTIVO DO FECHAMENTO PARA A IA
-            analysis = generate_ai_analysis(logs, current_desc, is_first, reason)
-            
-            if analysis and "Erro IA" not in analysis:
-                notion_updates = {}
-                actions_taken = []
-
-                if "[NOVO_TITULO:" in analysis:
-                    match = re.search(r'\[NOVO_TITULO: (.*?)\]', analysis)
-                    if match:
-                        raw_title = match.group(1).strip()
-                        new_title = sanitize_notion_text(raw_title)
-                        notion_updates["Descricao"] = {"rich_text": [{"text": {"content": new_title}}]}
-                        actions_taken.append(f"🔄 Título ajustado: *'{new_title}'*")
-                        analysis = analysis.replace(match.group(0), "")
-
-                if "[FECHAR_CHAMADO]" in analysis:
-                    analysis = analysis.replace("[FECHAR_CHAMADO]", "")
-                    notion_updates["Status"] = {"status": {"name": "Finalizado"}}
-                    actions_taken.append("✨ Chamado encerrado (Resolvido).")
-
-                if notion_updates:
-                    update_ticket_properties(ticket_id, notion_updates)
-
-                append_comment_to_ticket(ticket_id, "IA Bot", analysis, is_summary=True)
-                final_msg += "\n\n✅ *Relatório IA:*"
-                if actions_taken:
-                    for action in actions_taken: final_msg += f"\n{action}"
-                else:
-                    final_msg += "\nResumo anexado ao histórico."
-            else:
-                final_msg += f"\n\n⚠️ Erro na IA: {analysis}"
+        if ticket_id in notion_outbox: asyncio.create_task(flush_ticket_outbox(ticket_id))
+        if log_count(chat_id) and ticket_id:
+            # Resumo sai da fila de IA; o grupo fecha na hora
+            enqueue_summary(chat_id, ticket_id, is_first, reason)
+            final_msg += "\n\n⏳ Gerando relatório IA..."
         
         await context.bot.send_message(chat_id, final_msg, parse_mode='Markdown')
         
-        if chat_id in session_logs: del session_logs[chat_id]
+        log_reset(chat_id)
         if chat_id in active_ticket_session: del active_ticket_session[chat_id]
         if ticket_id in ticket_first_session: del ticket_first_session[ticket_id]
         
@@ -374,41 +2108,509 @@ async def lock_group_globally(chat_id, context, reason="manual"):
         return True, ""
     except Exception as e: return False, str(e)
 
+# --- FILA DE RESUMOS IA ---
+summary_queue = asyncio.Queue()
+summary_workers = []
+
+def enqueue_summary(chat_id, ticket_id, is_first, reason):
+    job_id = f"{ticket_id}-{time.time_ns()}"
+    log_file = log_freeze(chat_id, f"resumo_{job_id}")
+    summary_jobs[job_id] = {'chat_id': chat_id, 'ticket_id': ticket_id, 'log_file': log_file, 'is_first': is_first, 'reason': reason, 'tries': 0}
+    summary_queue.put_nowait(job_id)
+
+async def retry_summary_later(job_id):
+    job = summary_jobs.get(job_id)
+    if not job or job['tries'] + 1 >= IA_JOB_TENTATIVAS: return False
+    job['tries'] += 1
+    summary_jobs.touch(job_id)
+    await save_state_async()
+    asyncio.get_running_loop().call_later(IA_JOB_ESPERA, summary_queue.put_nowait, job_id)
+    return True
+
+async def run_summary_job(bot, job_id):
+    job = summary_jobs.get(job_id)
+    if not job: return
+    ticket_id = job['ticket_id']
+    current_desc = await get_ticket_desc(ticket_id)
+    # PASSA O MOTIVO DO FECHAMENTO PARA A IA
+    logs = job.get('logs') or [] # jobs anteriores ao LOG_DIR guardavam o log no próprio estado
+    if job.get('log_file'): logs = await session_log_io_call(read_log_file, job['log_file'])
+    analysis = await generate_ai_analysis(logs, current_desc, job['is_first'], job['reason'])
+
+    unavailable = bool(analysis) and analysis.startswith("IA Indisponível")
+    if unavailable and await retry_summary_later(job_id): return
+
+    # Esgotadas as tentativas, "IA Indisponível" é falha: não vai para o ticket como se fosse resumo
+    if analysis and "Erro IA" not in analysis and not unavailable:
+        notion_updates = {}
+        actions_taken = []
+
+        if "[NOVO_TITULO:" in analysis:
+            match = re.search(r'\[NOVO_TITULO: (.*?)\]', analysis)
+            if match:
+                raw_title = match.group(1).strip()
+                new_title = sanitize_notion_text(raw_title)
+                notion_updates["Descricao"] = {"rich_text": [{"text": {"content": new_title}}]}
+                actions_taken.append(f"🔄 Título ajustado: *'{new_title}'*")
+                analysis = analysis.replace(match.group(0), "")
+
+        if "[FECHAR_CHAMADO]" in analysis:
+            analysis = analysis.replace("[FECHAR_CHAMADO]", "")
+            notion_updates["Status"] = {"status": {"name": "Finalizado"}}
+            actions_taken.append("✨ Chamado encerrado (Resolvido).")
+
+        if notion_updates:
+            await update_ticket_properties(ticket_id, notion_updates)
+
+        # Mensagens pendentes entram antes do resumo
+        await flush_ticket_outbox(ticket_id)
+        await append_comment_to_ticket(ticket_id, "IA Bot", analysis, is_summary=True)
+        final_msg = f"✅ *Relatório IA ({ticket_id}):*"
+        if actions_taken:
+            for action in actions_taken: final_msg += f"\n{action}"
+        else:
+            final_msg += "\nResumo anexado ao histórico."
+    else:
+        final_msg = f"⚠️ Erro na IA ({ticket_id}): {analysis}"
+    await finish_summary_job(bot, job_id, final_msg)
+
+async def finish_summary_job(bot, job_id, final_msg):
+    job = summary_jobs.get(job_id)
+    if not job: return
+    try: await bot.send_message(job['chat_id'], final_msg, parse_mode='Markdown')
+    except Exception as e: logger.error(f"Erro envio relatório {job['chat_id']}: {e}")
+    summary_jobs.pop(job_id, None)
+    if job.get('log_file'): session_log_io.submit(remove_log_file, job['log_file'])
+    await save_state_async()
+
+async def summary_worker(app):
+    while True:
+        job_id = await summary_queue.get()
+        try: await run_summary_job(app.bot, job_id)
+        except Exception as e:
+            logger.error(f"Erro resumo {job_id}: {e}")
+            # Última tentativa: avisa o chat e descarta o job (senão ele volta a cada restart)
+            try:
+                if not await retry_summary_later(job_id):
+                    job = summary_jobs.get(job_id) or {}
+                    await finish_summary_job(app.bot, job_id, f"⚠️ Erro na IA ({job.get('ticket_id')}): o resumo falhou após {IA_JOB_TENTATIVAS} tentativas.")
+            except Exception as e: logger.error(f"Erro ao descartar resumo {job_id}: {e}")
+        finally: summary_queue.task_done()
+
+def requeue_summary_jobs():
+    # Reenfileira resumos que ficaram pendentes antes de um restart. Roda logo após o load_state, antes da
+    # inatividade poder travar grupos: jobs novos já entram pela enqueue_summary e não podem ir duas vezes para a fila
+    for job_id in list(summary_jobs): summary_queue.put_nowait(job_id)
+
+def start_summary_workers(app):
+    for _ in range(IA_WORKERS): summary_workers.append(asyncio.create_task(summary_worker(app)))
+
+# --- AVISOS (BROADCAST) ---
+class RateLimiter:
+    # Espaça chamadas para no máximo `rate` por segundo; pause() atende RetryAfter do Telegram
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = 0
+        self.lock = asyncio.Lock()
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0: await asyncio.sleep(delay)
+    def pause(self, seconds):
+        self.next = max(self.next, time.monotonic() + seconds)
+
+telegram_limiter = RateLimiter(TELEGRAM_MSGS_POR_SEGUNDO)
+
+def retry_after_seconds(e):
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+async def send_announcement(bot, cid, text):
+    # Retorna None se enviou, senão o motivo da falha
+    last_error = ""
+    for attempt in range(AVISO_TENTATIVAS):
+        await telegram_limiter.wait()
+        try:
+            await bot.send_message(cid, text, parse_mode='Markdown')
+            return None
+        except RetryAfter as e:
+            telegram_limiter.pause(retry_after_seconds(e))
+            metric_count('bot_telegram_retentativas_total', metodo='sendMessage')
+            last_error = "RetryAfter"
+        except (BadRequest, Forbidden) as e: return str(e)
+        except (TimedOut, NetworkError) as e:
+            metric_count('bot_telegram_retentativas_total', metodo='sendMessage')
+            last_error = str(e)
+            # Mínimo de 1s entre tentativas no mesmo chat
+            await asyncio.sleep(2 ** attempt)
+    return last_error or "Falha"
+
+async def run_broadcast(bot, msg, chat_ids, admin_chat, status_msg_id):
+    text = f"📢 *COMUNICADO HypeIT*\n━━━━━━━━\n\n{msg}"
+    sem = asyncio.Semaphore(AVISO_CONCORRENCIA)
+    sent, failed = [0], {}
+
+    async def one(cid):
+        async with sem:
+            err = await send_announcement(bot, cid, text)
+            if err: failed[cid] = err
+            else: sent[0] += 1
+
+    async def progress():
+        while True:
+            await asyncio.sleep(AVISO_PROGRESSO_SEGUNDOS)
+            try: await bot.edit_message_text(chat_id=admin_chat, message_id=status_msg_id, text=f"⏳ Enviando... {sent[0] + len(failed)}/{len(chat_ids)} | Falhas: {len(failed)}")
+            except Exception: pass
+
+    prog = asyncio.create_task(progress())
+    try: await asyncio.gather(*(one(cid) for cid in chat_ids))
+    finally: prog.cancel()
+
+    run_id = datetime.now(TIMEZONE).strftime("%Y%m%d%H%M%S")
+    broadcast_runs[run_id] = {'msg': msg, 'sent': sent[0], 'failed': failed}
+    for old in sorted(broadcast_runs)[:-AVISO_HISTORICO]: del broadcast_runs[old]
+    await save_state_async()
+
+    report = f"✅ OK: {sent[0]} | Falhas: {len(failed)}\nExecução: {run_id}"
+    if failed:
+        report += "\n\nFalharam:\n" + "\n".join(f"{cid}: {err[:60]}" for cid, err in list(failed.items())[:20])
+        if len(failed) > 20: report += f"\n... e mais {len(failed) - 20}"
+        report += f"\n\nReenviar só para estes: /reaviso {run_id}"
+    await bot.edit_message_text(chat_id=admin_chat, message_id=status_msg_id, text=report)
+
+# --- FECHAMENTO AGENDADO ---
+# Início/fim do expediente: fecha os grupos abertos em paralelo. O Telegram passa pelo telegram_limiter (o mesmo
+# dos avisos); Notion e IA já têm seus limites (notion_sem e a fila de resumos). A concorrência é escolhida para
+# caber em FECHAMENTO_ALVO_SEGUNDOS, usando o tempo por grupo medido nas varreduras anteriores.
+async def close_group_scheduled(app, cid):
+    # Retorna None se fechou e mandou o menu, senão o motivo da falha
+    err = ""
+    for attempt in range(FECHAMENTO_TENTATIVAS):
+        if attempt: await asyncio.sleep(2 ** attempt)
+        for _ in range(2): await telegram_limiter.wait() # aviso de encerramento e menu
+        async with chat_lock(cid):
+            if group_status.get(cid) == 'OPEN':
+                # Fechamento Agendado (Passa 'inactivity' ou 'manual' para evitar fechar ticket)
+                ok, err = await lock_group_globally(cid, app, reason="inactivity", cause='agendado')
+                if not ok and group_status.get(cid) == 'OPEN': continue
+            elif attempt == 0: return None # fechado por outro caminho antes da vez dele
+            try:
+                await show_menu_new_msg(cid, app, "🔒 *Menu Automático*")
+                return None
+            except Exception as e: err = f"menu: {e}"
+    return err or "Falha"
+
+def scheduled_lock_concurrency(n_groups):
+    per_group = bot_meta.get('lock_seconds_per_group', FECHAMENTO_SEG_POR_GRUPO)
+    wanted = -(-int(n_groups * per_group) // FECHAMENTO_ALVO_SEGUNDOS)
+    return max(FECHAMENTO_CONCORRENCIA_MIN, min(FECHAMENTO_CONCORRENCIA_MAX, wanted))
+
+async def scheduled_lock(app):
+    chats = [c for c in list(CLIENT_GROUPS) if group_status.get(c) == 'OPEN']
+    if not chats: return
+    concurrency = scheduled_lock_concurrency(len(chats))
+    sem = asyncio.Semaphore(concurrency)
+    done, failed = [0], {}
+    t0 = time.monotonic()
+    status_msg = None
+    if ADMIN_ID:
+        try: status_msg = await app.bot.send_message(ADMIN_ID, f"🔒 Fechamento agendado: {len(chats)} grupos abertos ({concurrency} em paralelo, alvo {FECHAMENTO_ALVO_SEGUNDOS}s)")
+        except Exception as e: logger.error(f"Erro aviso fechamento ao admin: {e}")
+
+    async def one(cid):
+        async with sem:
+            started = time.monotonic()
+            try: err = await close_group_scheduled(app, cid)
+            except Exception as e: err = str(e)
+            metric_observe('bot_fechamento_grupo_segundos', time.monotonic() - started)
+            if err:
+                failed[cid] = err
+                logger.error(f"Erro fechamento agendado {cid}: {err}")
+            else: done[0] += 1
+
+    async def progress():
+        while True:
+            await asyncio.sleep(FECHAMENTO_PROGRESSO_SEGUNDOS)
+            try: await app.bot.edit_message_text(chat_id=ADMIN_ID, message_id=status_msg.message_id, text=f"⏳ Fechando... {done[0] + len(failed)}/{len(chats)} | Falhas: {len(failed)} | {time.monotonic() - t0:.0f}s")
+            except Exception: pass
+
+    prog = asyncio.create_task(progress()) if status_msg else None
+    try: await asyncio.gather(*(one(cid) for cid in chats))
+    finally:
+        if prog: prog.cancel()
+
+    elapsed = time.monotonic() - t0
+    # Tempo por grupo "sequencial equivalente", suavizado, para dimensionar a próxima varredura
+    measured = elapsed * concurrency / len(chats)
+    bot_meta['lock_seconds_per_group'] = 0.5 * bot_meta.get('lock_seconds_per_group', measured) + 0.5 * measured
+    await save_state_async()
+
+    if not status_msg: return
+    report = f"🔒 Fechamento agendado: {done[0]}/{len(chats)} em {elapsed:.0f}s | Falhas: {len(failed)}"
+    if elapsed > FECHAMENTO_ALVO_SEGUNDOS: report += f"\n⚠️ Passou do alvo de {FECHAMENTO_ALVO_SEGUNDOS}s"
+    if failed:
+        report += "\n\nFalharam:\n" + "\n".join(f"{CLIENT_GROUPS.get(cid, cid)} ({cid}): {err[:60]}" for cid, err in list(failed.items())[:20])
+        if len(failed) > 20: report += f"\n... e mais {len(failed) - 20}"
+    try: await app.bot.edit_message_text(chat_id=ADMIN_ID, message_id=status_msg.message_id, text=report)
+    except Exception as e: logger.error(f"Erro relatório fechamento: {e}")
+
+# --- ANALÍTICO ---
+# Log de eventos de atendimento (abertura, fechamento, mensagem, chamado criado) em colunas: cada coluna é um
+# array.array em memória (só o que ainda não foi gravado) e um arquivo binário append-only em ANALITICO_DIR/<worker>/.
+# O /relatorio lê as colunas direto (memmap, recortando o período por busca binária em ts) e agrega com numpy,
+# que só é importado ali. Nada vai ao Notion.
+EV_ABERTURA, EV_FECHAMENTO, EV_MENSAGEM, EV_CHAMADO = range(4)
+CAUSAS_FECHAMENTO = ['manual', 'inatividade', 'agendado', 'cancelado', 'start'] # code dos fechamentos
+TIPOS_MENSAGEM = ['texto', 'foto', 'audio'] # code das mensagens
+ANALITICO_COLUNAS = (('ts', 'd'), ('chat', 'q'), ('user', 'q'), ('kind', 'B'), ('code', 'B'))
+
+class EventLog:
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.cols = {name: array.array(tc) for name, tc in ANALITICO_COLUNAS}
+        self.repaired = False
+
+    def record(self, kind, chat, user=0, code=0):
+        c = self.cols
+        c['ts'].append(time.time()); c['chat'].append(chat); c['user'].append(user or 0); c['kind'].append(kind); c['code'].append(code)
+
+    def repair(self):
+        # Queda no meio de um flush deixa colunas com tamanhos diferentes: corta todas no menor
+        self.path.mkdir(parents=True, exist_ok=True)
+        files = {name: self.path / f"{name}.bin" for name, _ in ANALITICO_COLUNAS}
+        rows = min((files[name].stat().st_size if files[name].exists() else 0) // array.array(tc).itemsize for name, tc in ANALITICO_COLUNAS)
+        for name, tc in ANALITICO_COLUNAS:
+            with open(files[name], 'ab') as f: f.truncate(rows * array.array(tc).itemsize)
+        self.repaired = True
+
+    def flush(self):
+        if not len(self.cols['ts']): return 0
+        if not self.repaired: self.repair()
+        n = len(self.cols['ts'])
+        for name, col in self.cols.items():
+            with open(self.path / f"{name}.bin", 'ab') as f: col.tofile(f)
+            del col[:]
+        return n
+
+event_log = EventLog(os.path.join(ANALITICO_DIR, re.sub(r'\W+', '_', SHARD_ID).strip('_') or 'local'))
+analytics_task = None
+
+async def analytics_loop():
+    while True:
+        await asyncio.sleep(ANALITICO_FLUSH_SEGUNDOS)
+        try: event_log.flush()
+        except OSError as e: logger.error(f"Erro analítico: {e}")
+
+def start_analytics_flusher():
+    global analytics_task
+    analytics_task = asyncio.create_task(analytics_loop())
+
+def analytics_load(np, since):
+    # Junta as colunas de todos os workers a partir de `since`; ts é crescente dentro de cada pasta
+    parts = {name: [] for name, _ in ANALITICO_COLUNAS}
+    root = pathlib.Path(ANALITICO_DIR)
+    for d in sorted(root.iterdir()) if root.is_dir() else []:
+        files = {name: d / f"{name}.bin" for name, _ in ANALITICO_COLUNAS}
+        if not all(f.exists() for f in files.values()): continue
+        rows = min(files[name].stat().st_size // np.dtype(tc).itemsize for name, tc in ANALITICO_COLUNAS)
+        if not rows: continue
+        cols = {name: np.memmap(files[name], dtype=tc, mode='r', shape=(rows,)) for name, tc in ANALITICO_COLUNAS}
+        # Relógio que voltou (NTP, migração) quebra a ordem: aí filtra por máscara em vez de busca binária
+        ts = cols['ts']
+        sel = slice(int(np.searchsorted(ts, since)), None) if not (np.diff(ts) < 0).any() else ts >= since
+        for name in parts: parts[name].append(np.array(cols[name][sel]))
+    return {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=tc) for name, tc in ANALITICO_COLUNAS}
+
+def analytics_aggregate(np, ev, bucket_seconds, tz_offset):
+    # Ordena por (chat, ts) e marca, para cada evento, a última abertura e o último fechamento antes dele.
+    # Um evento está numa sessão se a última abertura é do mesmo chat e mais nova que o último fechamento.
+    order = np.lexsort((ev['ts'], ev['chat']))
+    ts, chat, user, kind, code = (ev[c][order] for c in ('ts', 'chat', 'user', 'kind', 'code'))
+    idx = np.arange(len(ts))
+    is_open, is_close, is_msg = kind == EV_ABERTURA, kind == EV_FECHAMENTO, kind == EV_MENSAGEM
+    last_open = np.maximum.accumulate(np.where(is_open, idx, -1))
+    last_close = np.maximum.accumulate(np.where(is_close, idx, -1))
+    prev_close = np.concatenate(([-1], last_close[:-1]))
+    opener = np.maximum(last_open, 0)
+    same_chat = chat[opener] == chat
+    # Duração: fechamento cuja sessão começou no mesmo chat depois do fechamento anterior
+    closed = is_close & (last_open > prev_close) & same_chat
+    dur_at, dur = idx[closed], ts[closed] - ts[opener[closed]]
+    # Primeira resposta: primeira mensagem na sessão de alguém que não é quem abriu
+    resp = is_msg & (last_open > last_close) & same_chat & (user != user[opener])
+    sess, first = np.unique(opener[resp], return_index=True)
+    ttfr_at, ttfr = sess, ts[idx[resp][first]] - ts[sess]
+
+    def grouped(keys):
+        # keys: grupo de cada evento (já ordenado como ts); devolve contagens e medianas por grupo
+        uniq, inv = np.unique(keys, return_inverse=True)
+        m = len(uniq)
+        count = lambda mask: np.bincount(inv[mask], minlength=m)
+        out = {'keys': uniq, 'aberturas': count(is_open), 'mensagens': count(is_msg), 'chamados': count(kind == EV_CHAMADO),
+               'fechamentos': {c: count(is_close & (code == i)) for i, c in enumerate(CAUSAS_FECHAMENTO)}}
+        for name, at, vals in (('resposta', ttfr_at, ttfr), ('duracao', dur_at, dur)):
+            g = inv[at]
+            o = np.lexsort((vals, g))
+            g, vals = g[o], vals[o]
+            cuts = np.flatnonzero(np.diff(g)) + 1
+            med = np.full(m, np.nan)
+            if len(g): med[g[np.concatenate(([0], cuts))]] = [np.median(v) for v in np.split(vals, cuts)]
+            out[name] = med
+        return out
+
+    buckets = ((ts + tz_offset) // bucket_seconds).astype(np.int64)
+    quant = lambda v, q: float(np.quantile(v, q)) if len(v) else float('nan')
+    totals = {'aberturas': int(is_open.sum()), 'mensagens': int(is_msg.sum()), 'chamados': int((kind == EV_CHAMADO).sum()),
+              'fechamentos': {c: int((is_close & (code == i)).sum()) for i, c in enumerate(CAUSAS_FECHAMENTO)},
+              'sem_resposta': int(is_open.sum()) - len(ttfr),
+              'resposta': (quant(ttfr, 0.5), quant(ttfr, 0.9)), 'duracao': (quant(dur, 0.5), quant(dur, 0.9))}
+    return totals, grouped(chat), grouped(buckets)
+
+def fmt_duration(seconds):
+    if seconds != seconds: return "-" # NaN: sem amostras
+    seconds = int(seconds)
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+def analytics_report(days, chats=None):
+    # Roda numa thread (to_thread): lê as colunas, agrega e devolve o texto do relatório
+    import numpy as np
+    since = time.time() - days * 86400
+    ev = analytics_load(np, since)
+    if chats is not None:
+        keep = np.isin(ev['chat'], list(chats))
+        ev = {name: col[keep] for name, col in ev.items()}
+    if not len(ev['ts']): return f"📈 Relatório {days} dia(s): nenhum evento registrado."
+    bucket = 86400 if days <= 14 else 7 * 86400
+    tz_offset = datetime.now(TIMEZONE).utcoffset().total_seconds()
+    totals, per_client, per_period = analytics_aggregate(np, ev, bucket, tz_offset)
+    closes = " · ".join(f"{c} {n}" for c, n in totals['fechamentos'].items() if n) or "nenhum"
+    lines = [f"📈 Relatório {days} dia(s) (desde {datetime.fromtimestamp(since, TIMEZONE).strftime('%d/%m %H:%M')})",
+             f"Sessões: {totals['aberturas']} | Chamados: {totals['chamados']} | Msgs: {totals['mensagens']}",
+             f"Fechamentos: {closes}",
+             f"1ª resposta: p50 {fmt_duration(totals['resposta'][0])} · p90 {fmt_duration(totals['resposta'][1])} · sem resposta {totals['sem_resposta']}",
+             f"Duração: p50 {fmt_duration(totals['duracao'][0])} · p90 {fmt_duration(totals['duracao'][1])}"]
+    top = np.argsort(-per_client['aberturas'], kind='stable')[:ANALITICO_TOP_CLIENTES]
+    lines.append(f"\nPor cliente (top {len(top)} de {len(per_client['keys'])}, por sessões):")
+    for i in top:
+        fech = per_client['fechamentos']
+        lines.append(f"• {CLIENT_GROUPS.get(int(per_client['keys'][i]), str(per_client['keys'][i]))}: {per_client['aberturas'][i]} sessões · "
+                     f"{per_client['chamados'][i]} chamados · {per_client['mensagens'][i]} msgs · 1ª resp {fmt_duration(per_client['resposta'][i])} · "
+                     f"duração {fmt_duration(per_client['duracao'][i])} · inatividade {fech['inatividade'][i]}/manual {fech['manual'][i]}")
+    lines.append(f"\nPor {'dia' if bucket == 86400 else 'semana'}:")
+    for i, key in enumerate(per_period['keys']):
+        start = datetime.fromtimestamp(int(key) * bucket - tz_offset, TIMEZONE).strftime('%d/%m')
+        lines.append(f"• {start}: {per_period['aberturas'][i]} sessões · {per_period['chamados'][i]} chamados · "
+                     f"{per_period['mensagens'][i]} msgs · 1ª resp {fmt_duration(per_period['resposta'][i])}")
+    return "\n".join(lines)
+
 # --- COMANDOS ---
+@instrumented("cmd:aviso")
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return 
-    refresh_clients_from_notion()
     msg = " ".join(context.args)
     if not msg:
         await update.message.reply_text("⚠️ Use: `/aviso msg`")
         return
-    st = await update.message.reply_text(f"⏳ Enviando...")
-    s, f = 0, 0
-    for cid in CLIENT_GROUPS:
-        try:
-            await context.bot.send_message(cid, f"📢 *COMUNICADO HypeIT*\n━━━━━━━━\n\n{msg}", parse_mode='Markdown')
-            s += 1
-        except: f += 1
-    await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=st.message_id, text=f"✅ OK: {s} | Falhas: {f}")
+    await refresh_clients_from_notion()
+    st = await update.message.reply_text(f"⏳ Enviando para {len(CLIENT_GROUPS)} grupos...")
+    await run_broadcast(context.bot, msg, list(CLIENT_GROUPS), update.effective_chat.id, st.message_id)
+
+@instrumented("cmd:reaviso")
+async def rebroadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Reenvia um aviso só para os chats que falharam (última execução se nenhuma for informada)
+    if update.effective_user.id != ADMIN_ID: return
+    run_id = context.args[0] if context.args else (max(broadcast_runs) if broadcast_runs else None)
+    run = broadcast_runs.get(run_id)
+    if not run:
+        await update.message.reply_text("⚠️ Execução não encontrada. Use: `/reaviso [execução]`")
+        return
+    if not run['failed']:
+        await update.message.reply_text(f"✅ Execução {run_id} não teve falhas.")
+        return
+    st = await update.message.reply_text(f"⏳ Reenviando para {len(run['failed'])} grupos...")
+    await run_broadcast(context.bot, run['msg'], list(run['failed']), update.effective_chat.id, st.message_id)
+
+@instrumented("cmd:metricas")
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    endpoint = f"http://{METRICAS_HOST}:{METRICAS_PORTA}/metrics" if METRICAS_PORTA else "desligado (METRICAS_PORTA)"
+    # Sem Markdown: nomes de métricas e rótulos têm '_'
+    await update.message.reply_text(f"📊 Métricas\n{metrics_summary_text()}\n\nEndpoint: {endpoint}")
 
+@instrumented("cmd:buscar")
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Num grupo de cliente busca só os chamados dele; fora dos grupos, só o admin busca (em todos)
+    cid = update.effective_chat.id
+    client = CLIENT_GROUPS.get(cid)
+    if client is None and update.effective_user.id != ADMIN_ID: return
+    query = " ".join(context.args or [])
+    if not query.strip():
+        await update.message.reply_text("Uso: /buscar <palavras>  (ex.: /buscar olt sem sinal)")
+        return
+    t0 = time.perf_counter()
+    rows = await asyncio.to_thread(ticket_mirror.search, query, client)
+    ms = (time.perf_counter() - t0) * 1000
+    if rows is None:
+        await update.message.reply_text("⚠️ Busca indisponível no momento.")
+        return
+    if not rows:
+        await update.message.reply_text(f"🔎 Nada encontrado para \"{query}\".")
+        return
+    # Sem Markdown: trechos vêm do texto livre dos chamados
+    lines = [f"🔎 {len(rows)} chamado(s) para \"{query}\" ({ms:.0f} ms):"]
+    for tid, cli, status, trecho in rows:
+        where = "" if client else f" · {cli}"
+        lines.append(f"\n{tid}{where} · {status}\n{trecho.strip()}")
+    await update.message.reply_text("\n".join(lines)[:4000])
+
+@instrumented("cmd:relatorio")
+async def report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /relatorio [dias] [trecho do nome do cliente]
+    if update.effective_user.id != ADMIN_ID: return
+    args = list(context.args or [])
+    days = int(args.pop(0)) if args and args[0].isdigit() else ANALITICO_DIAS_PADRAO
+    chats = None
+    if args:
+        needle = " ".join(args).lower()
+        chats = {cid for cid, name in CLIENT_GROUPS.items() if needle in name.lower()}
+        if not chats:
+            await update.message.reply_text(f"Nenhum cliente com \"{needle}\" no nome.")
+            return
+    event_log.flush()
+    try: text = await asyncio.to_thread(analytics_report, max(1, days), chats)
+    except ImportError:
+        await update.message.reply_text("⚠️ O relatório precisa do numpy (pip install numpy).")
+        return
+    # Sem Markdown: nomes de clientes podem ter '_' e '*'
+    for i in range(0, len(text), 4000): await update.message.reply_text(text[i:i + 4000])
+
+@instrumented("cmd:debug")
 async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    sync = refresh_clients_from_notion()
+    sync = await refresh_clients_from_notion()
     cid = update.effective_chat.id
     st = group_status.get(cid, "UNK")
-    logs = len(session_logs.get(cid, []))
+    logs = log_count(cid)
     active = active_ticket_session.get(cid, "Nenhum")
-    await update.message.reply_text(f"🛠 *Status*\nSync: {sync}\nGrupo: {st}\nMsgs Log: {logs}\nTicket Ativo: {active}", parse_mode='Markdown')
+    r = state_rates()
+    persist = f"{r['saves']:.2f} saves/s | {r['flushes']:.2f} lotes/s | {r['records']:.2f} chaves/s | {state_stats['compactions']} compactações"
+    await update.message.reply_text(f"🛠 *Status*\nSync: {sync}\nGrupo: {st}\nMsgs Log: {logs}\nTicket Ativo: {active}\nEstado: {persist}\n\n🤖 *Modelos IA*\n{model_stats_text()}\n\n📥 *Fila por chat*\n{chat_queue_text()}\n\n🌐 *Webhook*\n{webhook_stats_text()}\n\n🗂 *Espelho*\n{mirror_stats_text()}\n\n🚀 *Boot*\n{boot_stats_text()}", parse_mode='Markdown')
 
+@instrumented("cmd:start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    name = get_client_name(cid)
+    name = await resolve_client_name(cid)
     if str(cid) == name: 
         await context.bot.send_message(cid, f"⚠️ Grupo {cid} não cadastrado.")
         return
-    await lock_group_globally(cid, context)
+    await lock_group_globally(cid, context, cause='start')
     await show_menu_new_msg(cid, context, f"🤖 *Atendimento {name}*")
 
+@instrumented("cmd:fim")
 async def manual_lock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Fechamento Manual (Pode fechar se resolvido)
     await lock_group_globally(update.effective_chat.id, context, reason="manual")
@@ -422,6 +2624,7 @@ async def show_menu_new_msg(chat_id, context, text):
     ]
     await context.bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
+@instrumented(lambda u: "btn:" + (u.callback_query.data or "").split('_')[0])
 async def btn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     
@@ -439,7 +2642,7 @@ async def btn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif q.data == 'wait_yes': await flow_new(cid, uid, context, q)
     elif q.data == 'wait_no':
-        ok, e = await open_group_globally(cid, context)
+        ok, e = await open_group_globally(cid, context, uid)
         if ok:
             user_states[k] = {"state": WAITING_NEW_TICKET}
             await save_state_async()
@@ -457,24 +2660,19 @@ async def btn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif q.data == 'cancel':
         if k in user_states: del user_states[k]; await save_state_async()
         # Cancelamento manual (Também não deve fechar ticket)
-        await lock_group_globally(cid, context, reason="inactivity") 
+        await lock_group_globally(cid, context, reason="inactivity", cause='cancelado')
         await menu_inline(q, "🚫 *Operação Cancelada.*")
 
     elif q.data in ['list_update', 'list_view']:
-        tkts = get_active_tickets_data(cid)
-        if not tkts:
-            kb = [[InlineKeyboardButton("🔙 Voltar", callback_data='back')]]
-            await q.edit_message_text("📂 Nenhum chamado ativo.", reply_markup=InlineKeyboardMarkup(kb))
-            return
-        kb = []
-        p = "upd_" if q.data == 'list_update' else "vw_"
-        for t in tkts: kb.append([InlineKeyboardButton(f"[{t['id']}] {t['desc']}", callback_data=f"{p}{t['id']}")])
-        kb.append([InlineKeyboardButton("🔙 Voltar", callback_data='back')])
-        await q.edit_message_text("👇 *Selecione:*", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        await show_ticket_list(q, cid, q.data.split('_')[1], 0)
+
+    elif q.data.startswith('lsp_'):
+        _, mode, page = q.data.split('_')
+        await show_ticket_list(q, cid, mode, int(page))
 
     elif q.data.startswith('upd_'):
         tid = q.data.split('_')[1]
-        ok, e = await open_group_globally(cid, context)
+        ok, e = await open_group_globally(cid, context, uid)
         if ok:
             user_states[k] = {"state": WAITING_COMMENT, "ticket_id": tid}
             active_ticket_session[cid] = tid 
@@ -484,15 +2682,36 @@ async def btn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif q.data.startswith('vw_'):
         tid = q.data.split('_')[1]
-        hist = get_ticket_history(tid)
-        kb = [[InlineKeyboardButton("🔙 Voltar", callback_data='back')]]
-        await q.edit_message_text(f"📊 *Histórico {tid}:*\n\n{hist}", reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        await show_history_page(q, tid, 0)
+
+    elif q.data.startswith('vwp_'):
+        _, tid, page = q.data.split('_')
+        await show_history_page(q, tid, int(page))
 
     elif q.data == 'back':
         await menu_inline(q, "🤖 *Menu Principal*")
 
+async def show_ticket_list(q, cid, mode, page):
+    tkts = await get_active_tickets_data(cid)
+    if not tkts:
+        kb = [[InlineKeyboardButton("🔙 Voltar", callback_data='back')]]
+        await q.edit_message_text("📂 Nenhum chamado ativo.", reply_markup=InlineKeyboardMarkup(kb))
+        return
+    pages = (len(tkts) + CHAMADOS_POR_PAGINA - 1) // CHAMADOS_POR_PAGINA
+    page = max(0, min(page, pages - 1))
+    kb = []
+    p = "upd_" if mode == 'update' else "vw_"
+    for t in tkts[page * CHAMADOS_POR_PAGINA:(page + 1) * CHAMADOS_POR_PAGINA]: kb.append([InlineKeyboardButton(f"[{t['id']}] {t['desc']}", callback_data=f"{p}{t['id']}")])
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"lsp_{mode}_{page - 1}"))
+    if page < pages - 1: nav.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"lsp_{mode}_{page + 1}"))
+    if nav: kb.append(nav)
+    kb.append([InlineKeyboardButton("🔙 Voltar", callback_data='back')])
+    title = "👇 *Selecione:*" + (f" ({page + 1}/{pages})" if pages > 1 else "")
+    await q.edit_message_text(title, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+
 async def flow_new(cid, uid, context, q):
-    ok, e = await open_group_globally(cid, context)
+    ok, e = await open_group_globally(cid, context, uid)
     if ok:
         user_states[f"{uid}_{cid}"] = {"state": WAITING_NEW_TICKET}
         await save_state_async()
@@ -509,12 +2728,15 @@ async def menu_inline(q, text):
     ]
     await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
 
+@instrumented(lambda u: "msg:" + ("voice" if u.message.voice else "photo" if u.message.photo else "text"))
 async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid, cid = update.effective_user.id, update.effective_chat.id
-    user_name = update.effective_user.first_name
+    cid = update.effective_chat.id
     
     text_content = ""
     
+    kind = 'audio' if update.message.voice else 'foto' if update.message.photo else 'texto'
+    event_log.record(EV_MENSAGEM, cid, update.effective_user.id, TIPOS_MENSAGEM.index(kind))
+
     if update.message.text:
         text_content = update.message.text
         
@@ -522,43 +2744,37 @@ async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text_content = "[O usuário enviou uma IMAGEM]"
         
     elif update.message.voice:
+        # Transcrição roda na fila de áudios; o resultado volta por handle_content
         status_msg = await update.message.reply_text("🎙️ Transcrevendo áudio...")
-        try:
-            file_id = update.message.voice.file_id
-            new_file = await context.bot.get_file(file_id)
-            file_path = f"temp_voice_{cid}.ogg"
-            await new_file.download_to_drive(file_path)
-            
-            transcription = transcribe_audio(file_path)
-            
-            if transcription and not transcription.startswith("Erro"):
-                text_content = transcription 
-                safe_transcription = sanitize_notion_text(transcription)
-                await status_msg.edit_text(f"🎙️ **Transcrição:**\n_{safe_transcription}_", parse_mode='Markdown')
-            else:
-                error_msg = transcription if transcription else "Erro desconhecido"
-                text_content = f"[Áudio enviado ({error_msg})]"
-                await status_msg.edit_text(f"⚠️ {error_msg}")
-            
-            if os.path.exists(file_path): os.remove(file_path)
-            
-        except Exception as e:
-            logger.error(f"Erro audio: {e}")
-            text_content = "[Áudio enviado (Erro processamento)]"
-            await status_msg.edit_text("⚠️ Erro ao processar áudio.")
+        cached = await get_cached_transcription(update.message.voice.file_unique_id)
+        if cached is not None:
+            await handle_content(update, context, await transcribe_voice(update, context, status_msg, cached))
+            return
+        touch_activity(cid)
+        await save_state_async()
+        try: audio_queue.put_nowait((update, context, status_msg))
+        except asyncio.QueueFull:
+            await status_msg.edit_text("⚠️ Muitos áudios na fila, tente em instantes.")
+            await handle_content(update, context, "[Áudio enviado (Fila cheia)]")
+        return
 
     if not text_content: return 
+    await handle_content(update, context, text_content)
+
+async def handle_content(update, context, text_content):
+    uid, cid = update.effective_user.id, update.effective_chat.id
+    user_name = update.effective_user.first_name
 
-    last_activity[cid] = datetime.now(TIMEZONE)
+    touch_activity(cid)
     await save_state_async()
     
     if group_status.get(cid) == 'OPEN':
-        if cid not in session_logs: session_logs[cid] = []
-        session_logs[cid].append(f"{user_name}: {text_content}")
+        log_append(cid, f"{user_name}: {text_content}")
         
-        if update.message.photo:
-            tid = active_ticket_session.get(cid)
-            if tid: append_comment_to_ticket(tid, user_name, "📷 [IMAGEM ENVIADA PELO CLIENTE]")
+        tid = active_ticket_session.get(cid)
+        if tid:
+            note = "📷 [IMAGEM ENVIADA PELO CLIENTE]" if update.message.photo else text_content
+            await queue_ticket_comment(tid, user_name, note)
 
     k = f"{uid}_{cid}"
     data = user_states.get(k)
@@ -569,10 +2785,11 @@ async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if st == WAITING_NEW_TICKET:
             safe_desc = sanitize_notion_text(text_content)
             
-            tid, e = create_ticket(user_name, safe_desc, cid)
+            tid, e = await create_ticket(user_name, safe_desc, cid)
             if e: await update.message.reply_text(f"❌ Erro: {e}")
             else: 
                 await update.message.reply_text(f"✅ *Chamado {tid} Aberto!*", parse_mode='Markdown')
+                event_log.record(EV_CHAMADO, cid, uid)
                 active_ticket_session[cid] = tid
                 ticket_first_session[tid] = True
                 
@@ -581,48 +2798,91 @@ async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     if pid: await context.bot.delete_message(cid, pid); del prompt_messages[k]
                 except: pass
 
-            del user_states[k]
+            user_states.pop(k, None)
             await save_state_async()
             
         elif st == WAITING_COMMENT:
             pass 
 
-async def job_init(app):
-    load_state()
-    if not CLIENT_GROUPS: refresh_clients_from_notion()
+# Boot em duas fases: job_init só carrega o estado persistido (clientes, grupos, sessões) e liga o que não depende
+# de SDK pesado, então o bot já atende; finish_boot aquece os SDKs numa thread e só então liga o que usa IA/Notion
+# em segundo plano (workers, agendador, espelho) e atualiza o diretório de clientes.
+boot_task = None
+boot_stats = {} # fase -> segundos desde BOOT_T0
+
+def start_scheduler(app):
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
     s = AsyncIOScheduler(timezone=TIMEZONE)
     s.add_job(refresh_clients_from_notion, 'interval', minutes=30)
-    
-    async def lock():
-        for c in CLIENT_GROUPS:
-            if group_status.get(c) == 'OPEN':
-                try: 
-                    # Fechamento Agendado (Passa 'inactivity' ou 'manual' para evitar fechar ticket)
-                    await lock_group_globally(c, app, reason="inactivity")
-                    await show_menu_new_msg(c, app, "🔒 *Menu Automático*")
-                except: pass
-            
-    async def inact():
-        n = datetime.now(TIMEZONE)
-        for c in CLIENT_GROUPS:
-            if group_status.get(c) == 'OPEN' and last_activity.get(c) and (n - last_activity[c] > timedelta(minutes=MINUTOS_INATIVIDADE)):
-                try: 
-                    # Fechamento por Inatividade (PROIBIDO fechar ticket)
-                    await lock_group_globally(c, app, reason="inactivity")
-                    await show_menu_new_msg(c, app, "🔒 *Fechado por Inatividade*")
-                except Exception as e: logger.error(f"Erro inact {c}: {e}")
-    s.add_job(lock, 'cron', day_of_week='mon-fri', hour=HORA_INICIO_EXPEDIENTE)
-    s.add_job(lock, 'cron', day_of_week='mon-fri', hour=HORA_FIM_EXPEDIENTE)
-    s.add_job(inact, 'interval', minutes=1)
+    s.add_job(prune_transcription_cache, 'cron', hour=3)
+    s.add_job(scheduled_lock, 'cron', day_of_week='mon-fri', hour=HORA_INICIO_EXPEDIENTE, args=[app])
+    s.add_job(scheduled_lock, 'cron', day_of_week='mon-fri', hour=HORA_FIM_EXPEDIENTE, args=[app])
     s.start()
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(job_init).build()
+async def finish_boot(app):
+    boot_stats['sdks'] = await asyncio.to_thread(warm_sdks)
+    start_summary_workers(app)
+    start_audio_workers()
+    start_scheduler(app)
+    start_mirror_sync()
+    sync = await refresh_clients_from_notion()
+    boot_stats['completo'] = time.perf_counter() - BOOT_T0
+    logger.info(f"Boot completo em {boot_stats['completo']:.2f}s (SDKs {boot_stats['sdks']:.2f}s, clientes: {sync})")
+
+async def job_init(app):
+    global boot_task
+    load_state()
+    requeue_summary_jobs()
+    load_session_logs()
+    start_session_log_flusher()
+    start_inactivity_scheduler(app)
+    start_outbox_flusher()
+    start_analytics_flusher()
+    await start_metrics_server()
+    boot_stats['pronto'] = time.perf_counter() - BOOT_T0
+    if BOOT_RAPIDO: boot_task = asyncio.create_task(finish_boot(app))
+    else: await finish_boot(app)
+
+def boot_stats_text():
+    fmt = lambda k: f"{boot_stats[k]:.2f}s" if k in boot_stats else "em andamento"
+    return f"pronto {fmt('pronto')} | SDKs {fmt('sdks')} | completo {fmt('completo')} ({'rápido' if BOOT_RAPIDO else 'bloqueante'})"
+
+async def job_stop(app):
+    if boot_task: boot_task.cancel()
+    for w in summary_workers + audio_workers: w.cancel()
+    if inactivity_task: inactivity_task.cancel()
+    if outbox_task: outbox_task.cancel()
+    if mirror_task: mirror_task.cancel()
+    if analytics_task: analytics_task.cancel()
+    if session_log_task: session_log_task.cancel()
+    await flush_session_logs()
+    session_log_io.shutdown(wait=True)
+    event_log.flush()
+    for tid in list(notion_outbox): await flush_ticket_outbox(tid)
+    await flush_state()
+    await compact_state()
+    if metrics_server: metrics_server.close()
+    ticket_mirror.close()
+    await notion_http.aclose()
+
+def register_handlers(application):
     application.add_handler(CommandHandler(['start', 'iniciar'], start))
     application.add_handler(CommandHandler('fim', manual_lock))
     application.add_handler(CommandHandler('aviso', broadcast_command))
+    application.add_handler(CommandHandler('reaviso', rebroadcast_command))
     application.add_handler(CommandHandler('debug', debug_cmd))
+    application.add_handler(CommandHandler('metricas', metrics_cmd))
+    application.add_handler(CommandHandler('buscar', search_cmd))
+    application.add_handler(CommandHandler('relatorio', report_cmd))
     application.add_handler(CallbackQueryHandler(btn_handler))
     application.add_handler(MessageHandler((filters.TEXT | filters.PHOTO | filters.VOICE) & ~filters.COMMAND, msg_handler))
-    print("Bot rodando com persistência e IA v6.8...")
-    application.run_polling()
+
+if __name__ == '__main__' and SHARD_MODO == 'router':
+    print(f"Router de shards: {len(SHARD_WORKERS)} workers configurados...")
+    asyncio.run(run_router())
+elif __name__ == '__main__':
+    application = ApplicationBuilder().token(TELEGRAM_TOKEN).request(MetricsRequest(connection_pool_size=TELEGRAM_CONEXOES)).concurrent_updates(ChatUpdateProcessor(MAX_UPDATES_ADMITIDOS, MAX_UPDATES_SIMULTANEOS)).post_init(job_init).post_shutdown(job_stop).build()
+    register_handlers(application)
+    print(f"Bot rodando com persistência e IA v6.8 ({SHARD_MODO or BOT_MODO})...")
+    if BOT_MODO == 'webhook' or SHARD_MODO == 'worker': asyncio.run(run_webhook(application))
+    else: application.run_polling()